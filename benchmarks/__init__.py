@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""benchmarks of ce_detector on synthetic data"""
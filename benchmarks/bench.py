@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""benchmarks of every stage of ce_detector on synthetic data
+
+Every stage runs in a fresh process so that its peak resident set size is
+measured on its own, peak RSS of child processes it waited for is reported
+besides. Inputs are generated by
+:func:`benchmarks.synthetic.generate`, nothing is downloaded.
+
+usage: python -m benchmarks.bench --genes 200 --depth 20
+"""
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent import futures
+from functools import partial
+
+import click
+
+from benchmarks.synthetic import generate
+from ce_detector.metrics import peak_rss
+from ce_detector.utils import get_alias
+
+
+def detect_junctions(data):
+    """junction maps of every chromosome of synthetic data"""
+    from ce_detector.detector import JunctionDetector
+    from ce_detector.detector import JunctionMap
+
+    detector = JunctionDetector(data["bam"], data["reference"], 0)
+
+    return {
+        chrom: detector.worker(
+            detector.bam, detector.reference, chrom, seqid, 0, 0, JunctionMap(chrom)
+        )
+        for chrom, seqid in get_alias().items()
+        if chrom in detector.bam.references
+    }
+
+
+def annotate_junctions(data, junctionmaps):
+    """annotate junction maps by index compiled from synthetic data"""
+    from ce_detector.annotator import Annotator
+    from ce_detector.index import AnnotationIndex
+
+    index = os.path.join(os.path.dirname(data["db"]), "annotation.idx")
+    if not AnnotationIndex.is_index(index):
+        AnnotationIndex.from_db(data["db"]).save(index)
+
+    annotator = Annotator(index)
+    return {
+        chrom: annotator.run(junctionmap=jmap) for chrom, jmap in junctionmaps.items()
+    }
+
+
+def setup_worker(data, repeat):
+    """sweep bam file and annotate slice sites of every chromosome"""
+    return partial(detect_junctions, data), data["reads"], "reads"
+
+
+def setup_get_pvalue(data, repeat):
+    """p-values of counted junctions of every chromosome as in the pipeline"""
+    from ce_detector.detector import JunctionDetector
+
+    detector = JunctionDetector(data["bam"], data["reference"], 0)
+    counted = [
+        detector.count_junctions(detector.bam.fetch(chrom), 0)
+        for chrom in detector.bam.references
+    ]
+
+    def func():
+        for junctions, blocks in counted:
+            detector.get_pvalue(
+                [blocks[junction][1:] for junction, _ in sorted(junctions.items())]
+            )
+
+    return func, sum(len(junctions) for junctions, _ in counted), "junctions"
+
+
+def setup_annotate(data, repeat):
+    """annotate junction maps by compiled index"""
+    annotate_junctions(data, detect_junctions(data))  # compile index
+    # junction maps are annotated in place, every run gets its own
+    runs = [detect_junctions(data) for _ in range(repeat)]
+    items = sum(map(len, runs[0].values()))
+
+    return lambda: annotate_junctions(data, runs.pop()), items, "junctions"
+
+
+def setup_find_ce(data, repeat):
+    """find cryptic exons and their children in annotated junction maps"""
+    from ce_detector.scanner import find_ce
+
+    junctionmaps = annotate_junctions(data, detect_junctions(data))
+    tables = [jmap.table() for jmap in junctionmaps.values()]
+
+    def func():
+        for table in tables:
+            find_ce(table, long=True)
+
+    return func, sum(map(len, tables)), "annotations"
+
+
+def setup_detect(data, repeat):
+    """run the detect command end to end without cache"""
+    from ce_detector.cli import cli
+
+    output = os.path.join(tempfile.mkdtemp(), "cryptic_exons.tsv")
+    args = [
+        "detect",
+        "--bam",
+        data["bam"],
+        "--reference",
+        data["reference"],
+        "--gffdb",
+        data["db"],
+        "--out",
+        output,
+        "--no-cache",
+    ]
+
+    return (
+        partial(cli.main, args, standalone_mode=False, obj={}),
+        data["reads"],
+        "reads",
+    )
+
+
+# setup of every stage returns function to time, number and name of items
+SETUPS = dict(
+    worker=setup_worker,
+    get_pvalue=setup_get_pvalue,
+    annotate=setup_annotate,
+    find_ce=setup_find_ce,
+    detect=setup_detect,
+)
+STAGES = tuple(SETUPS)
+
+
+def run_stage(stage, data, repeat):
+    """run a stage and measure it
+
+    :return: best seconds of param:`repeat` runs, number of processed items,
+        name of items, peak RSS of stage process and of its children in MB
+    :rtype: tuple
+    """
+    func, items, unit = SETUPS[stage](data, repeat)
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    return (
+        min(seconds),
+        items,
+        unit,
+        peak_rss(),
+        peak_rss(resource.RUSAGE_CHILDREN),
+    )
+
+
+@click.command()
+@click.option("--chroms", default=2, show_default=True, help="number of chromosomes")
+@click.option(
+    "--genes", default=50, show_default=True, help="number of genes per chromosome"
+)
+@click.option(
+    "--depth", default=10, show_default=True, help="mean support of junctions"
+)
+@click.option(
+    "--background",
+    default=5000,
+    show_default=True,
+    help="number of unspliced reads per chromosome",
+)
+@click.option("--seed", default=0, show_default=True, help="seed of random numbers")
+@click.option("--repeat", default=3, show_default=True, help="runs of every stage")
+@click.option(
+    "--stage",
+    "stages",
+    multiple=True,
+    type=click.Choice(STAGES),
+    help="stages to run. Defaults to all",
+)
+@click.option(
+    "--data-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="directory of synthetic data. Defaults to a temporary directory",
+)
+@click.option(
+    "--json", "json_out", type=click.Path(), default=None, help="write results to json"
+)
+def main(chroms, genes, depth, background, seed, repeat, stages, data_dir, json_out):
+    """benchmark stages of ce_detector on synthetic data"""
+    data_dir = data_dir or tempfile.mkdtemp(prefix="ce_detector_bench_")
+    data = generate(
+        data_dir,
+        chroms=chroms,
+        genes=genes,
+        depth=depth,
+        background=background,
+        seed=seed,
+    )
+    click.echo(
+        f"data {data_dir}: {data['reads']} reads, {data['junctions']} junctions, "
+        f"{data['genes']} genes"
+    )
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for stage in stages or STAGES:
+        with futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            seconds, items, unit, rss, children_rss = pool.submit(
+                run_stage, stage, data, repeat
+            ).result()
+
+        results.append(
+            dict(
+                stage=stage,
+                seconds=seconds,
+                items=items,
+                unit=unit,
+                throughput=items / seconds,
+                peak_rss_mb=rss,
+                children_peak_rss_mb=children_rss,
+            )
+        )
+        click.echo(
+            f"{stage:<12}{seconds:>10.4f}s{items / seconds:>14.0f} {unit}/s"
+            f"{rss:>10.1f} MB{children_rss:>10.1f} MB"
+        )
+
+    if json_out:
+        with open(json_out, "w") as handle:
+            json.dump(dict(data=data, results=results), handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""deterministic generator of synthetic bam, fasta and gff inputs
+
+Every gene spans 10kb and has three exons in one transcript. A cryptic exon
+is planted in its first intron, supported by junction reads skipping it (DA),
+ending at it (D) and starting from it (A), and split by a nested junction (N).
+Motifs of all introns are written into the genome reference so that strands
+are detected, and unspliced reads are scattered as background.
+"""
+import os
+import random
+
+import gffutils
+import pysam as ps
+
+from ce_detector.utils import get_alias
+
+# span of a gene and its exons, introns are between exons
+GENE_SPAN = 10_000
+EXONS = ((0, 300), (4000, 4300), (7000, 7300))
+# cryptic exon in the first intron
+CRYPTIC_EXON = (1800, 2000)
+# length of reads
+READ_LENGTH = 100
+
+
+def plant_gene(rng, sequence, chrom, seqid, gene, offset, strand, depth):
+    """plant motifs of introns of a gene into sequence of its chromosome
+
+    :return: gff lines of gene, its reads as (chrom, start, cigar) and number
+        of its junctions
+    :rtype: tuple
+    """
+    donor, acceptor = ("GT", "AG") if strand == "+" else ("CT", "AC")
+
+    exons = [(offset + start, offset + end) for start, end in EXONS]
+    cryptic = (offset + CRYPTIC_EXON[0], offset + CRYPTIC_EXON[1])
+    # 0-based and half-open introns
+    introns = [
+        (exons[0][1], exons[1][0]),
+        (exons[1][1], exons[2][0]),
+        (exons[0][1], cryptic[0]),
+        (cryptic[1], exons[1][0]),
+        (cryptic[0] + 20, cryptic[0] + 120),
+    ]
+    for start, end in introns:
+        sequence[start : start + 2] = donor
+        sequence[end - 2 : end] = acceptor
+
+    gff = [
+        f"{seqid}\tsynthetic\tgene\t{exons[0][0] + 1}\t{exons[-1][1]}\t.\t{strand}\t.\tID={gene}",
+        f"{seqid}\tsynthetic\tmRNA\t{exons[0][0] + 1}\t{exons[-1][1]}\t.\t{strand}\t.\t"
+        f"ID={gene}.t1;Parent={gene}",
+    ]
+    for exon, (start, end) in enumerate(exons):
+        gff.append(
+            f"{seqid}\tsynthetic\texon\t{start + 1}\t{end}\t.\t{strand}\t.\t"
+            f"ID={gene}.e{exon};Parent={gene}.t1"
+        )
+
+    reads = []
+    for start, end in introns[:4]:
+        for _ in range(rng.randint(max(depth // 2, 1), max(depth * 3 // 2, 1))):
+            reads.append((chrom, start - 50, [(0, 50), (3, end - start), (0, 50)]))
+    start, end = introns[4]
+    for _ in range(4):
+        reads.append((chrom, start - 15, [(0, 15), (3, end - start), (0, 30)]))
+
+    return gff, reads, len(introns)
+
+
+def write_reference(output, sequences):
+    """write sequences of chromosomes as an indexed fasta file"""
+    with open(output, "w") as handle:
+        for seqid, sequence in sequences.items():
+            handle.write(f">{seqid}\n")
+            for start in range(0, len(sequence), 60):
+                handle.write(f"{sequence[start : start + 60]}\n")
+    ps.faidx(output)
+
+
+def write_bam(output, alias, length, reads):
+    """write reads as a sorted and indexed bam file
+
+    :param alias: (chrom, seqid) of every chromosome in order of header
+    :type alias: list
+    :param length: length of every chromosome
+    :type length: int
+    :param reads: (chrom, start, cigar) of every read
+    :type reads: list
+    """
+    order = {chrom: ind for ind, (chrom, _) in enumerate(alias)}
+    reads = sorted(reads, key=lambda read: (order[read[0]], read[1]))
+
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": chrom, "LN": length} for chrom, _ in alias],
+    }
+    with ps.AlignmentFile(output, "wb", header=header) as handle:
+        for ind, (chrom, start, cigar) in enumerate(reads):
+            read = ps.AlignedSegment(handle.header)
+            read.query_name = f"read{ind}"
+            read.reference_name, read.reference_start = chrom, start
+            read.cigartuples, read.mapping_quality = cigar, 60
+
+            query_length = sum(size for op, size in cigar if op == 0)
+            read.query_sequence = "A" * query_length
+            read.query_qualities = ps.qualitystring_to_array("I" * query_length)
+            handle.write(read)
+    ps.index(output)
+
+
+def generate(out, chroms=2, genes=20, depth=10, background=1000, seed=0, build_db=True):
+    """generate synthetic inputs into a directory
+
+    :param out: directory of output
+    :type out: str
+    :param chroms: number of chromosomes, named by alias table of chromosomes
+    :type chroms: int
+    :param genes: number of genes of every chromosome
+    :type genes: int
+    :param depth: mean number of reads supporting every junction
+    :type depth: int
+    :param background: number of unspliced reads of every chromosome
+    :type background: int
+    :param seed: seed of random numbers
+    :type seed: int
+    :param build_db: whether to build database of annotation file
+    :type build_db: bool
+    :return: paths of `bam`, `reference`, `gff` and `db`, and numbers of
+        `reads`, `junctions`, `genes` and `cryptic_exons`
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    os.makedirs(out, exist_ok=True)
+
+    alias = list(get_alias().items())[:chroms]
+    length = (genes + 1) * GENE_SPAN
+
+    sequences, gff, reads = {}, ["##gff-version 3"], []
+    n_junctions = 0
+
+    for chrom, seqid in alias:
+        sequence = [rng.choice("ACGT") for _ in range(length)]
+
+        for ind in range(genes):
+            gene_gff, gene_reads, gene_junctions = plant_gene(
+                rng,
+                sequence,
+                chrom,
+                seqid,
+                f"gene{chrom}_{ind + 1}",
+                1000 + ind * GENE_SPAN,
+                "+" if ind % 2 == 0 else "-",
+                depth,
+            )
+            gff.extend(gene_gff)
+            reads.extend(gene_reads)
+            n_junctions += gene_junctions
+
+        sequences[seqid] = "".join(sequence)
+
+        for _ in range(background):
+            reads.append(
+                (chrom, rng.randint(0, length - READ_LENGTH), [(0, READ_LENGTH)])
+            )
+
+    reference = os.path.join(out, "reference.fa")
+    write_reference(reference, sequences)
+
+    annotation = os.path.join(out, "annotation.gff")
+    with open(annotation, "w") as handle:
+        handle.write("\n".join(gff) + "\n")
+
+    bam = os.path.join(out, "reads.bam")
+    write_bam(bam, alias, length, reads)
+
+    db = os.path.join(out, "annotation.db")
+    if build_db:
+        gffutils.create_db(
+            annotation, db, merge_strategy="create_unique", keep_order=True, force=True
+        )
+
+    return dict(
+        bam=bam,
+        reference=reference,
+        gff=annotation,
+        db=db,
+        reads=len(reads),
+        junctions=n_junctions,
+        genes=genes * len(alias),
+        cryptic_exons=genes * len(alias),
+    )
@@ -4,17 +4,27 @@
 """
 from __future__ import annotations
 
-from collections import defaultdict
 from typing import Any
 
-import gffutils
 import numpy as np
 
-from .utils import get_yaml
+from . import metrics
+from .cache import fingerprint
+from .detector import JunctionMap
+from .index import AnnotationIndex
+from .index import derive_introns
+from .index import open_index
+from .index import overlap_pairs
+from .utils import get_alias
 from .utils import timethis
 
-# HardCode the information of chromosome because its name of two ref are not identical
-CHROMS = get_yaml()["chr2hg38"]
+
+def __getattr__(name):
+    # HardCode the information of chromosome because its name of two ref are not identical,
+    # CHROMS is loaded on first access instead of import
+    if name == "CHROMS":
+        return get_alias()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class Annotator:
@@ -22,16 +32,90 @@ class Annotator:
 
     :param junctionmap:  instance return :class:`ce_detector.detector.JunctionMap`
     :type junctionmap: instance
-    :param database: database of annotation files
+    :param database: database of annotation files or index compiled from it
     :type database: Any
     :param output: filename of annotated junction reads. Defaults to None
     :type output: TestIo
+    :param cache: cache of introns derived from database. Defaults to None
+    :type cache: :class:`ce_detector.cache.IntronCache`
+    :param chroms: chromosome in bam mapping to chromosome in annotation.
+        Defaults to :data:`CHROMS`
+    :type chroms: dict
     """
 
-    def __init__(self, database: Any, output=None):
+    def __init__(self, database: Any, output=None, cache=None, chroms=None):
         """Constructor of Annotator"""
-        self.database = gffutils.FeatureDB(database)
+        if AnnotationIndex.is_index(database):
+            self.database, self.index = None, open_index(database)
+        else:
+            import gffutils
+
+            self.database, self.index = gffutils.FeatureDB(database), None
         self.output = output
+        self.chroms = get_alias() if chroms is None else chroms
+
+        # introns are only derived from database
+        self.cache = cache if self.database is not None else None
+        self.fingerprint = fingerprint(database) if self.cache is not None else None
+
+    @staticmethod
+    def classify_junctions(starts, ends, junction_list):
+        """detect type of slice, number of skipped donors and acceptors of junction reads at once
+
+        type of slice including D A DA N NDA. All junction reads should overlap
+        the same gene. Known donors and acceptors are sorted so that membership
+        and skipped sites are answered by ``searchsorted``, pairs of donor and
+        acceptor are packed into one integer key for detecting type DA.
+
+        :param starts: starts of junction reads
+        :type starts: numpy.array
+        :param ends: ends of junction reads
+        :type ends: numpy.array
+        :param junction_list: known introns of gene as (donor, acceptor)
+        :type junction_list: numpy.array
+        :return: codes of type of slice (see :attr:`JunctionMap.TYPES`),
+            numbers of skipped donors, numbers of skipped acceptors
+        :rtype: tuple[numpy.array, numpy.array, numpy.array]
+        """
+        donors = np.asarray(starts, dtype=np.int64) + 1
+        acceptors = np.asarray(ends, dtype=np.int64)
+        junction_list = np.asarray(junction_list, dtype=np.int64)
+
+        known_donors = np.sort(junction_list[:, 0])
+        known_acceptors = np.sort(junction_list[:, 1])
+        known_pairs = np.sort(junction_list[:, 0] << 32 | junction_list[:, 1])
+
+        def skipped(known):
+            # known sites strictly inside (donor, acceptor)
+            return (
+                np.searchsorted(known, acceptors, side="left")
+                - np.searchsorted(known, donors, side="right")
+            ).clip(min=0)
+
+        def contains(known, values):
+            ind = np.searchsorted(known, values).clip(max=len(known) - 1)
+            return known[ind] == values
+
+        is_donor = contains(known_donors, donors)
+        is_acceptor = contains(known_acceptors, acceptors)
+
+        reads_types = np.select(
+            [
+                contains(known_pairs, donors << 32 | acceptors),
+                is_donor & is_acceptor,
+                is_donor,
+                is_acceptor,
+            ],
+            [
+                JunctionMap.TYPES.index("DA"),
+                JunctionMap.TYPES.index("NDA"),
+                JunctionMap.TYPES.index("D"),
+                JunctionMap.TYPES.index("A"),
+            ],
+            default=JunctionMap.TYPES.index("N"),
+        )
+
+        return reads_types, skipped(known_donors), skipped(known_acceptors)
 
     @staticmethod
     def detect_property(start, end, junction_list):
@@ -47,123 +131,132 @@ class Annotator:
         :type junction_list: numpy.array
         :return: type of slice, number of skipped donors, number of skipped acceptors
         """
-        known_donors = junction_list[:, 0]
-        known_acceptors = junction_list[:, 1]
-
-        donors_skipped = ((start + 1 < known_donors) & (known_donors < end)).sum()
-
-        acceptors_skipped = (
-            (start + 1 < known_acceptors) & (known_acceptors < end)
-        ).sum()
-
-        if [start + 1, end] in junction_list.tolist():
-
-            reads_type = "DA"
-
-        elif (start + 1 in known_donors) and (end in known_acceptors):
-
-            reads_type = "NDA"
-
-        elif (start + 1 in known_donors) and (end not in known_acceptors):
-
-            reads_type = "D"
-
-        elif (start + 1 not in junction_list[:, 0]) and (end in junction_list[:, 1]):
-
-            reads_type = "A"
-
-        else:
-
-            reads_type = "N"
-
-        return reads_type, donors_skipped, acceptors_skipped
-
-    def annotate_junction(self, read, result, db):
-        """annotate junction reads and write results to file
-
-        :param read: junction read return :class:`ce_detector.detector.Read`
-        :type read: instance
-        :param result: gene list used for annotation
-        :type result: defaultdict[Any, Any]
-        :param db: database of annotation file
-        :type db: instance of file
+        reads_types, donors_skipped, acceptors_skipped = Annotator.classify_junctions(
+            [start], [end], junction_list
+        )
+
+        return (
+            JunctionMap.TYPES[reads_types[0]],
+            donors_skipped[0],
+            acceptors_skipped[0],
+        )
+
+    def load_index(self, seqid, starts, ends, result):
+        """index of genes of a chromosome used to annotate junction reads
+
+        The compiled index is used if it is given. Otherwise genes of the
+        chromosome are queried from database once, and introns are only
+        derived for genes overlapping junction reads and missing in cache.
+
+        :param seqid: chromosome in annotation file
+        :type seqid: str
+        :param starts: starts of junction reads
+        :type starts: numpy.array
+        :param ends: ends of junction reads
+        :type ends: numpy.array
+        :param result: introns of genes already derived from database
+        :type result: dict
+        :return: instance of :class:`ce_detector.index.AnnotationIndex`
+        :rtype: instance
         """
-        chrom = read.chrom
-        start, end = read.start, read.end
-        region = f"{CHROMS[chrom]}:{start}-{end}"  # change chromosome
-
-        gene_list = []
-
-        for gene in db.features_of_type(("gene"), limit=region):
-
-            gene_list.append(gene.id)
-            # new gene
-            if gene.id not in result:
-                # transcript
-
-                for transcript in db.children(
-                    gene,
-                    level=1,
-                    featuretype=("primary_transcript", "transcript", "mRNA"),
-                ):  # mRNA may drop out
-
-                    # find all position of introns for every gene known junctions
-                    for junction in db.interfeatures(
-                        db.children(
-                            transcript,
-                            level=1,
-                            featuretype="exon",
-                            order_by="start",
-                        ),
-                        new_featuretype="intron",
-                    ):
-                        result[gene.id].append([junction.start, junction.end])
-
-                if (
-                    len(result[gene.id]) >= 1
-                ):  # drop gene with only one exon in terms of number of intron
-
-                    result[gene.id] = np.unique(result[gene.id], axis=0)
-
-                else:
-                    result.pop(gene.id)
-                    gene_list.pop()
-
-        # annotate junctions reads
-
-        for gene in gene_list:
-            junction_list = result[gene]
-
-            reads_type, donors_skipped, acceptors_skipped = self.detect_property(
-                start,
-                end,
-                junction_list,
-            )
-
-            read.information.append(
-                [reads_type, donors_skipped, acceptors_skipped, gene],
-            )
-            if self.output:
-                self.output.write(
-                    f"{read}\t{reads_type}\t{donors_skipped}\t{acceptors_skipped}\t{gene}\n",
-                )
+        if self.index is not None:
+            return self.index
+
+        genes = sorted(
+            (gene.start, gene.end, gene.id)
+            for gene in self.database.region(seqid=seqid, featuretype="gene")
+        )
+        _, gene_idx = overlap_pairs(
+            starts,
+            ends,
+            np.array([gene[0] for gene in genes], dtype=np.int64),
+            np.array([gene[1] for gene in genes], dtype=np.int64),
+        )
+
+        genes = [genes[gene] for gene in np.unique(gene_idx)]
+        missing = [gene_id for _, _, gene_id in genes if gene_id not in result]
+
+        if self.cache is not None:
+            result.update(self.cache.get(self.fingerprint, missing))
+
+        derived = {
+            gene_id: derive_introns(self.database, gene_id)
+            for gene_id in missing
+            if gene_id not in result
+        }
+        result.update(derived)
+
+        if self.cache is not None:
+            self.cache.put(self.fingerprint, derived)
+
+        records = []
+        for start, end, gene_id in genes:
+            # drop gene with only one exon in terms of number of intron
+            if len(result[gene_id]):
+                records.append((gene_id, start, end, result[gene_id]))
+
+        return AnnotationIndex.from_genes({seqid: records})
 
     @timethis(name="Junction Annotator", message=" ")
     def run(self, junctionmap, logger, verbose=False):
         """main function used to annotate junction reads
 
         pick all genes covered by one junction read and annotate all of them:
-        type of slice, number of skipped donors and number of skipped acceptors
+        type of slice, number of skipped donors and number of skipped acceptors.
+        Genes overlapping junction reads are found for the whole chromosome at once.
 
         """
+        # change chromosome
+        seqid = self.chroms.get(junctionmap.chrom, junctionmap.chrom)
+        starts, ends = junctionmap.columns["start"], junctionmap.columns["end"]
+
+        index = self.load_index(seqid, starts, ends, {})
+        genes = index.genes(seqid)
+        junction_idx, gene_idx = overlap_pairs(
+            starts, ends, index.gene_starts[genes], index.gene_ends[genes]
+        )
+        gene_idx = gene_idx + genes.start
+        gene_ids = index.gene_ids[gene_idx].tolist()
+
+        reads_types = np.empty(len(junction_idx), dtype=np.int8)
+        donors_skipped = np.empty(len(junction_idx), dtype=np.int64)
+        acceptors_skipped = np.empty(len(junction_idx), dtype=np.int64)
+
+        # classify all junction reads of a gene at once
+        order = np.argsort(gene_idx, kind="stable")
+        bounds = np.flatnonzero(np.diff(gene_idx[order])) + 1
+        for pairs in np.split(order, bounds):
+            if not len(pairs):
+                continue
+
+            junctions = junction_idx[pairs]
+            gene_types, gene_dk, gene_ak = self.classify_junctions(
+                starts[junctions], ends[junctions], index.introns(gene_idx[pairs[0]])
+            )
+            reads_types[pairs] = gene_types
+            donors_skipped[pairs], acceptors_skipped[pairs] = gene_dk, gene_ak
+
+        junctionmap.add_annotation(
+            junction_idx, reads_types, donors_skipped, acceptors_skipped, gene_ids
+        )
+        metrics.add_counts(
+            junctions=junctionmap.size(),
+            annotations=len(junction_idx),
+            genes=len(np.unique(gene_idx)),
+        )
+
+        if self.output:
+            for junction, reads_type, dk, ak, gene in zip(
+                junction_idx, reads_types, donors_skipped, acceptors_skipped, gene_ids
+            ):
+                self.output.write(
+                    f"{junctionmap[junction]}\t{junctionmap.TYPES[reads_type]}\t{dk}\t{ak}\t{gene}\n",
+                )
 
-        result = defaultdict(list)
-
-        # logger.info(f'Begin to annotate junctions!')
-
-        for _index, read in enumerate(junctionmap):
-            self.annotate_junction(read, result, self.database)
-            if verbose and _index % 1000 == 0:
-                logger.info(f"Chrom {junctionmap.chrom} {_index} Reads")
+        if verbose:
+            logger.info(
+                f"Chrom {junctionmap.chrom} {junctionmap.size()} Reads "
+                f"{len(junction_idx)} Annotations"
+            )
 
         return junctionmap
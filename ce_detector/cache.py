@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""persistent caches shared by runs and worker processes
+
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from . import __version__
+from .detector import JunctionMap
+
+# default bound of size of cached introns in bytes
+INTRON_CACHE_SIZE = 256 << 20
+
+# default bound of size of cached junction maps in bytes
+JUNCTION_CACHE_SIZE = 1 << 30
+
+
+def get_cache_dir():
+    """get directory of caches
+
+    :return: $CE_DETECTOR_CACHE_DIR or $XDG_CACHE_HOME/ce_detector
+    :rtype: str
+    """
+    if os.environ.get("CE_DETECTOR_CACHE_DIR"):
+        return os.environ["CE_DETECTOR_CACHE_DIR"]
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "ce_detector")
+
+
+def fingerprint(*paths, extra=()):
+    """fingerprint files by their real paths, sizes and modification times
+
+    :param paths: files to fingerprint
+    :type paths: str
+    :param extra: other values identifying the content
+    :type extra: Iterable
+    :return: hex digest of fingerprint
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(
+            f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode()
+        )
+
+    for value in extra:
+        digest.update(f"{value!r};".encode())
+
+    return digest.hexdigest()
+
+
+def find_bam_index(bam):
+    """find index file of bam file
+
+    :param bam: bam file
+    :type bam: str
+    :return: path of index file or None if absent
+    :rtype: str
+    """
+    for path in (
+        f"{bam}.bai",
+        f"{bam}.csi",
+        f"{os.path.splitext(bam)[0]}.bai",
+        f"{os.path.splitext(bam)[0]}.csi",
+    ):
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+
+class IntronCache:
+    """on-disk cache of unique introns of genes with LRU eviction
+
+    Introns are stored in a SQLite file keyed by the fingerprint of the
+    gffutils database and the gene id, so entries of a changed database are
+    never used. Every thread of every process opens its own connection, so
+    SQLite locking makes the cache safe to share across worker threads and
+    processes. Least recently used entries are evicted once the size of
+    cached introns exceeds ``max_size``.
+
+    :param path: directory of cache. Defaults to :func:`get_cache_dir`
+    :type path: str
+    :param max_size: bound of size of cached introns in bytes
+    :type max_size: int
+    """
+
+    BATCH = 500
+
+    def __init__(self, path=None, max_size=INTRON_CACHE_SIZE):
+        path = path or get_cache_dir()
+        os.makedirs(path, exist_ok=True)
+
+        self.path = os.path.join(path, "introns.sqlite")
+        self.max_size = max_size
+        self._local = threading.local()
+
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS introns ("
+            "database TEXT NOT NULL, gene TEXT NOT NULL, introns BLOB NOT NULL, "
+            "size INTEGER NOT NULL, accessed REAL NOT NULL, "
+            "PRIMARY KEY (database, gene))"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS introns_accessed ON introns (accessed)"
+        )
+
+    @property
+    def connection(self):
+        """connection of current thread, reopened in forked processes"""
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.connection = sqlite3.connect(
+                self.path, timeout=60, isolation_level=None
+            )
+            local.pid = os.getpid()
+
+        return local.connection
+
+    def __repr__(self):
+        return f"IntronCache({self.path!r}, max_size={self.max_size})"
+
+    def __getstate__(self):
+        # connection is reopened in worker processes
+        return dict(path=os.path.dirname(self.path), max_size=self.max_size)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get(self, database, genes):
+        """get cached introns of genes and mark them as recently used
+
+        :param database: fingerprint of database of annotation file
+        :type database: str
+        :param genes: gene ids
+        :type genes: Iterable
+        :return: gene id to array of (start, end) of introns, missing genes are absent
+        :rtype: dict
+        """
+        genes = list(genes)
+        result = {}
+
+        for ind in range(0, len(genes), self.BATCH):
+            batch = genes[ind : ind + self.BATCH]
+            marks = ",".join("?" * len(batch))
+
+            rows = self.connection.execute(
+                f"SELECT gene, introns FROM introns WHERE database = ? AND gene IN ({marks})",
+                [database, *batch],
+            ).fetchall()
+            for gene, introns in rows:
+                result[gene] = np.frombuffer(introns, dtype=np.int64).reshape(-1, 2)
+
+            if rows:
+                self.connection.execute(
+                    f"UPDATE introns SET accessed = ? WHERE database = ? AND gene IN ({marks})",
+                    [time.time(), database, *batch],
+                )
+
+        return result
+
+    def put(self, database, introns):
+        """cache introns of genes and evict least recently used entries
+
+        :param database: fingerprint of database of annotation file
+        :type database: str
+        :param introns: gene id to array of (start, end) of introns
+        :type introns: dict
+        """
+        if not introns:
+            return
+
+        now = time.time()
+        rows = [
+            (database, gene, blob, len(blob), now)
+            for gene, blob in (
+                (gene, np.ascontiguousarray(array, dtype=np.int64).tobytes())
+                for gene, array in introns.items()
+            )
+        ]
+
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO introns VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.evict()
+
+    def evict(self):
+        """remove least recently used entries until cache fits in ``max_size``"""
+        (total,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM introns"
+        ).fetchone()
+
+        if total <= self.max_size:
+            return
+
+        evicted = []
+        for rowid, size in self.connection.execute(
+            "SELECT rowid, size FROM introns ORDER BY accessed, rowid"
+        ):
+            if total <= self.max_size:
+                break
+            evicted.append((rowid,))
+            total -= size
+
+        self.connection.executemany("DELETE FROM introns WHERE rowid = ?", evicted)
+
+    def size(self):
+        """size of cached introns in bytes"""
+        (total,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM introns"
+        ).fetchone()
+        return total
+
+
+class JunctionCache:
+    """on-disk cache of junction maps of chromosomes detected from bam files
+
+    Columns of the junction map of a chromosome are stored in a ``.npz`` file
+    named by :meth:`key`, which fingerprints every input of detection, so
+    changed inputs never hit the cache. Files are replaced atomically, and
+    least recently used files are removed once their total size exceeds
+    ``max_size``.
+
+    :param path: directory of cache. Defaults to :func:`get_cache_dir`
+    :type path: str
+    :param max_size: bound of size of cached junction maps in bytes
+    :type max_size: int
+    """
+
+    def __init__(self, path=None, max_size=JUNCTION_CACHE_SIZE):
+        self.path = os.path.join(path or get_cache_dir(), "junctions")
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return f"JunctionCache({self.path!r}, max_size={self.max_size})"
+
+    @staticmethod
+    def key(bam, reference, chrom, ann_chrom, quality):
+        """key of junction map of a chromosome
+
+        :param bam: bam file
+        :type bam: str
+        :param reference: genome reference file
+        :type reference: str
+        :param chrom: chromosome in bam file
+        :type chrom: str
+        :param ann_chrom: chromosome in reference
+        :type ann_chrom: str
+        :param quality: quality used to filter low quality reads
+        :type quality: int
+        :return: fingerprint of inputs of detection
+        :rtype: str
+        """
+        index = find_bam_index(bam)
+        paths = (bam, reference) if index is None else (bam, index, reference)
+
+        return fingerprint(
+            *paths, extra=(chrom, ann_chrom, quality, JunctionMap.COLUMNS, __version__)
+        )
+
+    def filename(self, key):
+        return os.path.join(self.path, f"{key}.npz")
+
+    def get(self, key, chrom):
+        """load cached junction map and mark it as recently used
+
+        :param key: key return from :meth:`key`
+        :type key: str
+        :param chrom: chromosome of junction map
+        :type chrom: str
+        :return: instance from :class:`ce_detector.detector.JunctionMap` or None if missing
+        :rtype: instance
+        """
+        filename = self.filename(key)
+
+        try:
+            with np.load(filename) as data:
+                columns = {name: data[name] for name in JunctionMap.COLUMNS}
+        except (OSError, KeyError, ValueError):
+            return None
+
+        os.utime(filename)
+        junctionmap = JunctionMap(chrom)
+        junctionmap.columns = columns
+
+        return junctionmap
+
+    def put(self, key, junctionmap):
+        """cache columns of junction map and evict least recently used files
+
+        :param key: key return from :meth:`key`
+        :type key: str
+        :param junctionmap: instance from :class:`ce_detector.detector.JunctionMap`
+        :type junctionmap: instance
+        """
+        filename = self.filename(key)
+        temp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        with open(temp, "wb") as handle:
+            np.savez(handle, **junctionmap.columns)
+        os.replace(temp, filename)
+
+        self.evict()
+
+    def evict(self):
+        """remove least recently used files until cache fits in ``max_size``"""
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                files.append((stat.st_mtime_ns, entry.name, stat.st_size))
+
+        total = sum(size for _, _, size in files)
+        for _, name, size in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            total -= size
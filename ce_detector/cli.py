@@ -8,22 +8,24 @@
 @file: cli.py.py
 @time: 2020/12/28 10:21 PM
 """
-from concurrent import futures
+import cProfile
+import os
+import shutil
+import tempfile
+from functools import partial
 
 import click
-import gffutils
-import pandas as pd
-from rich.traceback import install
 
 from . import __version__
-from .detector import JunctionDetector
-from .main import detection
-from .main import main
+from . import metrics
+from . import profiler
+from .utils import FORMATS
+from .utils import get_alias
 from .utils import get_worker
-from .utils import get_yaml
+from .utils import measure
 
-
-install()
+# modules depending on pandas, pysam, gffutils and scipy are imported by
+# commands using them, so that `--help` and worker processes start quickly
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"], max_content_width=150)
 
@@ -46,6 +48,10 @@ def cli(ctx, verbose):
     2. genome reference
     3. annotation file
     """
+    from rich.traceback import install
+
+    install()
+
     ctx.ensure_object(dict)
     ctx.obj["verbose"] = verbose
 
@@ -81,6 +87,8 @@ def build(ctx, gff, out_directory):
     :type out_directory: str
     :return: {out directory}/{prefix of annotation file}.db
     """
+    import gffutils
+
     verbose = ctx.obj["verbose"]
     if verbose:
         pass
@@ -92,13 +100,60 @@ def build(ctx, gff, out_directory):
     )
 
 
+@cli.command(
+    "index",
+    short_help="compile database of annotation file into index",
+    options_metavar="<options>",
+)
+@click.argument("gffdb", type=click.Path(exists=True))
+@click.option(
+    "--out",
+    "-o",
+    help="The directory of index. Defaults to {prefix of database}.idx",
+    type=click.Path(),
+    default=None,
+    metavar="<path>",
+)
+@click.pass_context
+def index(ctx, gffdb, out):
+    """compile database of annotation file into index
+
+    compile gene spans and introns of every chromosome in database into compact arrays,
+    which are memory-mapped during annotation instead of querying the database for every junction read.
+    The index can be used as the database of `detect` command.
+
+    \f
+    :param ctx: click context used to pass parameters
+    :type ctx: ``click.Context``
+    :param gffdb: the path of database of annotation file
+    :type gffdb: str
+    :param out: the directory of index
+    :type out: str
+    :return: {out}/*.npy
+    """
+    from .index import AnnotationIndex
+
+    if out is None:
+        out = f"{os.path.splitext(gffdb)[0]}.idx"
+
+    AnnotationIndex.from_db(gffdb).save(out)
+
+
 @cli.command("detect", short_help="scan cryptic exons", options_metavar="<options>")
 @click.option(
     "--bam",
     "-b",
     help="The bam file (Bam or Sam format)",
-    required=True,
     type=click.Path(exists=True),
+    default=None,
+    metavar="<path>",
+)
+@click.option(
+    "--bam-list",
+    help="The list of bam files, one path or `sample<TAB>path` per line. "
+    "Output is a directory of results of every sample and cohort count matrices",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
     metavar="<path>",
 )
 @click.option(
@@ -121,16 +176,32 @@ def build(ctx, gff, out_directory):
 @click.option(
     "--out",
     "-o",
-    help="The output file of detected cryptic exons",
+    help="The output file of detected cryptic exons, or directory with --bam-list",
     default="cryptic_exons.bed",
     type=click.STRING,
     show_default=True,
     metavar="<path>",
 )
+@click.option(
+    "--format",
+    "fmt",
+    help="The format of output. bed.gz is compressed by bgzip and indexed by tabix, "
+    "parquet and arrow require pyarrow",
+    type=click.Choice(FORMATS),
+    default="tsv",
+    show_default=True,
+)
+@click.option(
+    "--children",
+    is_flag=True,
+    default=False,
+    help="Also write every junction read nested in cryptic exons, one per line, "
+    "to {out}.children.{format}",
+)
 @click.option(
     "--gffdb",
     "-db",
-    help="The database of annotation file",
+    help="The database of annotation file or its index built by `index` command",
     type=click.Path(exists=True),
     required=True,
     metavar="<path>",
@@ -144,9 +215,90 @@ def build(ctx, gff, out_directory):
     show_default=True,
     metavar="<int>",
 )
+@click.option(
+    "--window-size",
+    "-w",
+    help="size of genomic windows scheduled as detection tasks, 0 for whole chromosomes",
+    type=click.INT,
+    default=10_000_000,
+    show_default=True,
+    metavar="<int>",
+)
+@click.option(
+    "--cache-dir",
+    help="The directory of caches of introns and junction maps. "
+    "Defaults to $CE_DETECTOR_CACHE_DIR or ~/.cache/ce_detector",
+    type=click.Path(file_okay=False),
+    default=None,
+    metavar="<path>",
+)
+@click.option(
+    "--cache-size",
+    help="bound of size of cached introns of genes in MB",
+    type=click.INT,
+    default=256,
+    show_default=True,
+    metavar="<int>",
+)
+@click.option("--no-cache", is_flag=True, default=False, help="disable caches")
+@click.option(
+    "--alias",
+    help="yaml file mapping chromosomes in bam file to chromosomes in annotation file. "
+    "Defaults to chr2hg38 of chromosome.yml",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    metavar="<path>",
+)
+@click.option(
+    "--metrics",
+    "metrics_out",
+    help="The JSON report of wall time, CPU time, RSS change and processed items "
+    "of every stage and chromosome",
+    type=click.Path(dir_okay=False),
+    default=None,
+    metavar="<path>",
+)
+@click.option(
+    "--trace",
+    "trace_out",
+    help="The Chrome Trace Event file of stages of every chromosome and worker, "
+    "viewable in Perfetto or chrome://tracing",
+    type=click.Path(dir_okay=False),
+    default=None,
+    metavar="<path>",
+)
+@click.option(
+    "--profile",
+    "profile_dir",
+    help="The directory of cProfile stats merged from main process and every worker "
+    "task, and a summary of hot functions",
+    type=click.Path(file_okay=False),
+    default=None,
+    metavar="<path>",
+)
 @click.option("--parallel", is_flag=True, default=False, help="using parallel mode")
 @click.pass_context
-def detect(ctx, bam, reference, quality, gffdb, cutoff, out, parallel):
+def detect(
+    ctx,
+    bam,
+    bam_list,
+    reference,
+    quality,
+    gffdb,
+    cutoff,
+    out,
+    fmt,
+    children,
+    window_size,
+    cache_dir,
+    cache_size,
+    no_cache,
+    alias,
+    metrics_out,
+    trace_out,
+    profile_dir,
+    parallel,
+):
     """detect junction reads and scan cryptic exons
 
     \b
@@ -164,49 +316,145 @@ def detect(ctx, bam, reference, quality, gffdb, cutoff, out, parallel):
     :type cutoff: int
     :param bam: bam file
     :type bam: str
+    :param bam_list: list of bam files of samples
+    :type bam_list: str
     :param reference: genome reference file
     :type reference: str
     :param quality: quality used to filter low quality reads.Default:0
     :type quality: int
     :param gffdb: database file of annotation file
     :type gffdb: str
-    :param out: file name of detected cryptic exons
+    :param out: file name of detected cryptic exons, or directory of cohort results
     :type out: str
+    :param fmt: format of output, see :data:`ce_detector.scanner.FORMATS`
+    :type fmt: str
+    :param children: whether to write long-format table of children of cryptic exons
+    :type children: bool
+    :param window_size: size of genomic windows for detection
+    :type window_size: int
+    :param cache_dir: directory of caches
+    :type cache_dir: str
+    :param cache_size: bound of size of cached introns in MB
+    :type cache_size: int
+    :param no_cache: whether to disable caches
+    :type no_cache: bool
+    :param alias: yaml file of alias table of chromosomes
+    :type alias: str
+    :param metrics_out: file name of report of metrics
+    :type metrics_out: str
+    :param trace_out: file name of trace of stages
+    :type trace_out: str
+    :param profile_dir: directory of profile stats
+    :type profile_dir: str
     """
+    from .cache import IntronCache
+    from .cache import JunctionCache
+    from .cohort import cohort_pipeline
+    from .cohort import get_annotation_index
+    from .cohort import read_bam_list
+    from .cohort import write_cohort
+    from .index import get_seqids
+    from .main import collect_children
+    from .main import collect_result
+    from .main import get_contigs
+    from .main import pipeline
+    from .scanner import check_format
+    from .scanner import write_children
+    from .scanner import write_result
 
     verbose = ctx.obj["verbose"]
 
-    # change keys to be consist with chromosome's values
-    chroms: dict = get_yaml()["chr2hg38"]
+    if (bam is None) == (bam_list is None):
+        raise click.UsageError("exactly one of --bam and --bam-list is required")
+
+    # fail before detection if output can not be written
+    try:
+        check_format(fmt)
+    except ImportError as exc:
+        raise click.BadParameter(str(exc), param_hint="--format") from exc
+
+    if metrics_out is not None or trace_out is not None:
+        # records of worker processes are gathered in a temporary directory
+        directory = tempfile.mkdtemp(prefix="ce_detector_metrics_")
+        metrics.enable(directory)
+        ctx.call_on_close(
+            partial(metrics.finish, metrics_out, directory, trace=trace_out)
+        )
+
+    if profile_dir is not None:
+        # stats of tasks are merged once the command finishes
+        os.makedirs(profile_dir, exist_ok=True)
+        directory = tempfile.mkdtemp(prefix="tasks_", dir=profile_dir)
+        profiler.enable(directory)
+
+        profile = cProfile.Profile()
+        profile.enable()
 
-    tasks = {}
-    junctionmaps = {}
-    with get_worker(parallel) as executor:
-        for chrom, ann_chrom in chroms.items():
-            future = executor.submit(
-                detection, chrom, ann_chrom, bam, reference, quality, verbose
+        def report():
+            click.echo(profiler.finish(profile_dir, directory, profile))
+
+        ctx.call_on_close(report)
+
+    cache = None if no_cache else IntronCache(cache_dir, max_size=cache_size << 20)
+    junction_cache = None if no_cache else JunctionCache(cache_dir)
+
+    if bam_list is not None:
+        samples = read_bam_list(bam_list)
+        if no_cache:
+            # samples still share one index, compiled for this run only
+            index_dir = tempfile.mkdtemp(prefix="ce_detector_index_")
+            ctx.call_on_close(partial(shutil.rmtree, index_dir, ignore_errors=True))
+            gffdb = get_annotation_index(gffdb, index_dir)
+        else:
+            gffdb = get_annotation_index(gffdb, cache_dir)
+
+        with get_worker(parallel) as executor:
+            counts = cohort_pipeline(
+                executor,
+                samples,
+                reference,
+                quality,
+                window_size,
+                gffdb,
+                cutoff,
+                verbose,
+                get_alias(alias),
+                out,
+                fmt,
+                children=children,
+                cache=cache,
+                junction_cache=junction_cache,
             )
-            tasks[future] = chrom
-        for future in futures.as_completed(tasks):
-            junctionmaps[tasks[future]] = future.result()
-
-    fdr_junctionmaps = JunctionDetector.fdr_correction(junctionmaps)
-
-    tasks = {}
-    result = {}
-    with get_worker(parallel) as executor:
-        for chrom, jmap in fdr_junctionmaps.items():
-            future = executor.submit(main, jmap, gffdb, cutoff, verbose)
-            tasks[future] = chrom
-        for future in futures.as_completed(tasks):
-            result[tasks[future]] = future.result()
-
-    sorted_result = [result[chrom] for chrom in chroms]
-
-    final_result = [
-        jmap.result for jmap in sorted_result if isinstance(jmap.result, pd.DataFrame)
-    ]
-    pd.concat(final_result).to_csv(out, sep="\t", encoding="utf8", index=False)
+
+        write_cohort(counts, out)
+        return
+
+    # chromosomes with mapped reads in bam and known to annotation
+    contigs = get_contigs(bam, get_seqids(gffdb), get_alias(alias))
+    chroms = {chrom: seqid for chrom, (seqid, _) in contigs.items()}
+    counts = {chrom: mapped for chrom, (_, mapped) in contigs.items()}
+
+    sample = os.path.splitext(os.path.basename(bam))[0]
+    with metrics.labelled(sample=sample), measure("Pipeline"):
+        with get_worker(parallel) as executor:
+            junctionmaps = pipeline(
+                executor,
+                chroms,
+                bam,
+                reference,
+                quality,
+                window_size,
+                gffdb,
+                cutoff,
+                verbose,
+                cache=cache,
+                counts=counts,
+                junction_cache=junction_cache,
+            )
+
+    write_result(collect_result(junctionmaps), out, fmt)
+    if children:
+        write_children(collect_children(junctionmaps), out, fmt)
 
 
 if __name__ == "__main__":
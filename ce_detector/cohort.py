@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""detect cryptic exons of many samples in one run
+
+Samples share one executor, one compiled annotation index and the genome
+reference opened by every worker, and their chromosomes are scheduled
+together. Cryptic exons of a sample are written as soon as it is finished,
+and only its counts of junction reads and cryptic exons are kept to be
+gathered into sparse matrices in Matrix Market format.
+"""
+import os
+import shutil
+from concurrent import futures
+
+import pandas as pd
+from scipy import io
+from scipy import sparse
+
+from . import metrics
+from .cache import fingerprint
+from .cache import get_cache_dir
+from .detector import JunctionMap
+from .index import AnnotationIndex
+from .index import get_seqids
+from .main import collect_children
+from .main import collect_result
+from .main import get_contigs
+from .main import pipeline
+from .scanner import write_children
+from .scanner import write_result
+from .utils import measure
+
+# bound of number of samples whose tasks are submitted at the same time
+MAX_DRIVERS = 16
+
+# keys of rows of count matrices
+JUNCTION_KEYS = ["chrom", "start", "end", "strand"]
+CE_KEYS = ["chrom", "start", "end", "strand", "gene"]
+
+
+def read_bam_list(path):
+    """read samples from a list of bam files
+
+    Every line is either the path of a bam file or a sample name and the
+    path separated by tab. Blank lines and lines starting with `#` are
+    skipped. Sample name defaults to the file name without extension and
+    relative paths are resolved against the directory of the list.
+
+    :param path: list of bam files
+    :type path: str
+    :return: sample name to bam file in order of list
+    :rtype: dict
+    """
+    samples = {}
+
+    with open(path) as handle:
+        for line in handle:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            fields = line.split("\t")
+            bam = fields[-1].strip()
+            sample = (
+                fields[0].strip()
+                if len(fields) > 1
+                else os.path.splitext(os.path.basename(bam))[0]
+            )
+            bam = os.path.join(os.path.dirname(os.path.abspath(path)), bam)
+
+            if sample in samples:
+                raise ValueError(f"duplicated sample {sample} in {path}")
+            samples[sample] = bam
+
+    return samples
+
+
+def get_annotation_index(gffdb, cache_dir=None):
+    """index of annotation shared by all samples
+
+    A database of annotation file is compiled into an index once and kept in
+    the cache directory under its fingerprint, so introns of genes are never
+    derived again for other samples or later runs.
+
+    :param gffdb: database of annotation file or its index
+    :type gffdb: str
+    :param cache_dir: directory of caches. Defaults to :func:`ce_detector.cache.get_cache_dir`
+    :type cache_dir: str
+    :return: directory of index
+    :rtype: str
+    """
+    if AnnotationIndex.is_index(gffdb):
+        return gffdb
+
+    path = os.path.join(cache_dir or get_cache_dir(), "index", fingerprint(gffdb))
+
+    if not AnnotationIndex.is_index(path):
+        temp = f"{path}.{os.getpid()}.tmp"
+        AnnotationIndex.from_db(gffdb).save(temp)
+        try:
+            os.replace(temp, path)
+        except OSError:
+            # compiled by another process meanwhile
+            shutil.rmtree(temp, ignore_errors=True)
+
+    return path
+
+
+def cohort_pipeline(
+    executor,
+    samples,
+    reference,
+    quality,
+    window_size,
+    gffdb,
+    cutoff,
+    verbose,
+    alias,
+    output,
+    fmt="tsv",
+    children=False,
+    cache=None,
+    junction_cache=None,
+):
+    """detect, annotate and scan cryptic exons of many samples
+
+    :func:`ce_detector.main.pipeline` of every sample is driven by its own
+    thread and submits tasks to the shared executor, so chromosomes of
+    different samples are processed at the same time. FDR is corrected
+    within every sample. Every driver writes cryptic exons of its sample by
+    :func:`write_sample` and drops its junction maps, so memory does not
+    grow with the number of samples and finished samples survive a failure
+    of later ones.
+
+    :param executor: executor to submit tasks
+    :type executor: ``concurrent.futures.Executor``
+    :param samples: sample name to bam file
+    :type samples: dict
+    :param alias: chromosome in bam mapping to chromosome in annotation
+    :type alias: dict
+    :param output: directory of output
+    :type output: str
+    :param fmt: format of cryptic exons, see :data:`ce_detector.scanner.FORMATS`
+    :type fmt: str
+    :param children: whether to write long-format table of children of cryptic exons
+    :type children: bool
+    :return: sample name to counts return from :func:`write_sample` in order of param:`samples`
+    :rtype: dict
+    """
+    seqids = get_seqids(gffdb)
+    os.makedirs(output, exist_ok=True)
+
+    def run(sample, bam):
+        contigs = get_contigs(bam, seqids, alias)
+
+        with metrics.labelled(sample=sample), measure("Pipeline"):
+            junctionmaps = pipeline(
+                executor,
+                {chrom: seqid for chrom, (seqid, _) in contigs.items()},
+                bam,
+                reference,
+                quality,
+                window_size,
+                gffdb,
+                cutoff,
+                verbose,
+                cache=cache,
+                counts={chrom: mapped for chrom, (_, mapped) in contigs.items()},
+                junction_cache=junction_cache,
+            )
+
+            return write_sample(sample, junctionmaps, output, fmt, children)
+
+    with futures.ThreadPoolExecutor(
+        max_workers=max(min(len(samples), MAX_DRIVERS), 1)
+    ) as drivers:
+        jobs = {
+            sample: drivers.submit(run, sample, bam) for sample, bam in samples.items()
+        }
+
+        return {sample: job.result() for sample, job in jobs.items()}
+
+
+def junction_table(junctionmaps):
+    """table of junction reads of a sample
+
+    :param junctionmaps: chromosome to junction map
+    :type junctionmaps: dict
+    :return: columns chrom, start, end, strand, score
+    :rtype: pandas.DataFrame
+    """
+    return pd.concat(
+        [
+            pd.DataFrame(
+                dict(
+                    chrom=jmap.chrom,
+                    start=jmap.columns["start"],
+                    end=jmap.columns["end"],
+                    strand=pd.Categorical.from_codes(
+                        jmap.columns["strand"], categories=JunctionMap.STRANDS
+                    ),
+                    score=jmap.columns["score"],
+                )
+            )
+            for jmap in junctionmaps.values()
+        ]
+        or [pd.DataFrame(columns=[*JUNCTION_KEYS, "score"])],
+        ignore_index=True,
+    )
+
+
+def count_matrix(tables, keys, value):
+    """sparse matrix of counts of features of every sample
+
+    :param tables: sample name to table of features
+    :type tables: dict
+    :param keys: columns identifying a feature
+    :type keys: list
+    :param value: column of counts
+    :type value: str
+    :return: table of features sorted by keys, matrix of features by samples
+    :rtype: tuple[pandas.DataFrame, ``scipy.sparse.coo_matrix``]
+    """
+    df = pd.concat(
+        [
+            table.loc[:, [*keys, value]].assign(sample=ind)
+            for ind, table in enumerate(tables.values())
+        ],
+        ignore_index=True,
+    ).astype({key: str for key in keys if key not in ("start", "end")})
+
+    groups = df.groupby(keys, sort=True)
+    features = groups.size().index.to_frame(index=False)
+
+    matrix = sparse.coo_matrix(
+        (
+            df[value].values.astype("int64"),
+            (groups.ngroup().values, df["sample"].values),
+        ),
+        shape=(len(features), len(tables)),
+    )
+    matrix.sum_duplicates()
+
+    return features, matrix
+
+
+def write_matrix(prefix, features, samples, matrix):
+    """write count matrix in Matrix Market format with its rows and columns
+
+    :param prefix: prefix of output, `.mtx`, `.features.tsv` and `.samples.tsv` are appended
+    :type prefix: str
+    :param features: table of rows of matrix
+    :type features: pandas.DataFrame
+    :param samples: names of columns of matrix
+    :type samples: list
+    :param matrix: features by samples
+    :type matrix: ``scipy.sparse.coo_matrix``
+    """
+    io.mmwrite(f"{prefix}.mtx", matrix, field="integer")
+    features.to_csv(f"{prefix}.features.tsv", sep="\t", index=False)
+    pd.Series(list(samples), name="sample").to_csv(
+        f"{prefix}.samples.tsv", sep="\t", index=False
+    )
+
+
+def write_sample(sample, junctionmaps, output, fmt="tsv", children=False):
+    """write cryptic exons of a sample and keep its counts for matrices
+
+    :param sample: name of sample
+    :type sample: str
+    :param junctionmaps: chromosome to junction map of sample
+    :type junctionmaps: dict
+    :param output: directory of output, `{sample}.{fmt}` is written into it
+    :type output: str
+    :param fmt: format of cryptic exons, see :data:`ce_detector.scanner.FORMATS`
+    :type fmt: str
+    :param children: whether to write `{sample}.children.{fmt}` of children of cryptic exons
+    :type children: bool
+    :return: counts of junction reads passing FDR and reads supporting
+        inclusion of cryptic exons, that is the sum of `score_D` and `score_A`
+    :rtype: tuple[pandas.DataFrame, pandas.DataFrame]
+    """
+    result = collect_result(junctionmaps)
+    write_result(result, os.path.join(output, f"{sample}.{fmt}"), fmt)
+    if children:
+        write_children(
+            collect_children(junctionmaps), os.path.join(output, f"{sample}.{fmt}"), fmt
+        )
+
+    inclusion = result.loc[:, CE_KEYS].assign(
+        inclusion=result["score_D"].astype("int64") + result["score_A"]
+    )
+
+    return junction_table(junctionmaps), inclusion.reset_index(drop=True)
+
+
+def write_cohort(counts, output):
+    """write count matrices of cohort
+
+    Files written into directory param:`output`:
+    `junctions.*` of counts of junction reads passing FDR, and
+    `cryptic_exons.*` of reads supporting inclusion of cryptic exons.
+
+    :param counts: result return from :func:`cohort_pipeline`
+    :type counts: dict
+    :param output: directory of output
+    :type output: str
+    """
+    os.makedirs(output, exist_ok=True)
+
+    features, matrix = count_matrix(
+        {sample: junctions for sample, (junctions, _) in counts.items()},
+        JUNCTION_KEYS,
+        "score",
+    )
+    write_matrix(os.path.join(output, "junctions"), features, counts, matrix)
+
+    features, matrix = count_matrix(
+        {sample: inclusion for sample, (_, inclusion) in counts.items()},
+        CE_KEYS,
+        "inclusion",
+    )
+    write_matrix(os.path.join(output, "cryptic_exons"), features, counts, matrix)
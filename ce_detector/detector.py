@@ -3,57 +3,156 @@
 """class for detecting junction reads
 
 """
-import re
+import os
+import threading
 import time
+from collections import Counter
 
 import numpy as np
+import pandas as pd
 import pysam as ps
-from statsmodels.stats.multitest import fdrcorrection
 
+from . import metrics
+from .utils import measure
 from .utils import timethis
 
+# cigar operations which align read bases to reference bases
+MATCH = frozenset((ps.CMATCH, ps.CEQUAL, ps.CDIFF))
+
+# size of reference sequence loaded at once when fetching motifs
+SEQUENCE_CHUNK = 1 << 24
+
+
+def encode_motif(motif):
+    """encode a dinucleotide such as ``GT`` into a uint16 code
+
+    :param motif: dinucleotide of splice site
+    :type motif: str
+    :return: code of dinucleotide
+    :rtype: int
+    """
+    first, second = motif.ljust(2, "N")[:2].encode("ascii")
+    return first << 8 | second
+
+
+def decode_motif(code):
+    """decode a uint16 code into the dinucleotide
+
+    :param code: code return from :func:`encode_motif`
+    :type code: int
+    :return: dinucleotide of splice site
+    :rtype: str
+    """
+    code = int(code)
+    return chr(code >> 8) + chr(code & 0xFF)
+
+
+# genome references opened by every thread
+_references = threading.local()
+
+
+def open_reference(path):
+    """open genome reference once for every thread and reuse it across tasks
+
+    :param path: genome reference file
+    :type path: str
+    :return: handle of genome reference
+    :rtype: ``pysam.FastaFile``
+    """
+    handles = _references.__dict__.setdefault("handles", {})
+
+    if path not in handles:
+        handles[path] = ps.FastaFile(path)
+
+    return handles[path]
+
+
+def open_alignment(path):
+    """open bam file and load its index once for every thread and process
+
+    Tasks of a thread run one after another, so they share the handle
+    without interleaving their iterators.
+
+    :param path: bam file
+    :type path: str
+    :return: handle of bam file
+    :rtype: ``pysam.AlignmentFile``
+    """
+    handles = _references.__dict__.setdefault("alignments", {})
+    key = (os.getpid(), path)
+
+    if key not in handles:
+        handles[key] = ps.AlignmentFile(path)
+
+    return handles[key]
+
 
 class Read:
-    """build a read class for storing information of every junction read
+    """lightweight view of one junction read stored in :class:`JunctionMap`
 
-    :param chrom: chromosome of genome
-    :type chrom: str
-    :param start: start position of junction read
-    :type start: int
-    :param end: end position of junction read
-    :type end: int
-    :param idn: index of junction read
-    :type idn: int
-    :param score: support of junction read
-    :type score: int
-    :param strand: direction of junction read (-|+)
-    :type strand: str
-    :param anchor: anchor of junction read
-    :type anchor: str
-    :param acceptor: acceptor of junction read
-    :type acceptor: str
+    Attributes are read from columns of the junction map on access:
+    chrom, start, end, idn (index), score (support), strand (-|+|N),
+    anchor, acceptor, pvalue, qvalue and information (annotations).
 
+    :param junctionmap: junction map storing the read
+    :type junctionmap: instance
+    :param index: row of the read in junction map
+    :type index: int
     """
 
-    __slots__ = (
-        "chrom",
-        "start",
-        "end",
-        "idn",
-        "score",
-        "strand",
-        "anchor",
-        "acceptor",
-        "information",
-        "pvalue",
-    )
+    __slots__ = ("junctionmap", "index")
+
+    def __init__(self, junctionmap, index):
+        self.junctionmap, self.index = junctionmap, index
+
+    def value(self, name):
+        """raw value of the read in a column of junction map"""
+        return self.junctionmap.columns[name][self.index]
+
+    @property
+    def chrom(self):
+        return self.junctionmap.chrom
+
+    @property
+    def start(self):
+        return int(self.value("start"))
+
+    @property
+    def end(self):
+        return int(self.value("end"))
+
+    @property
+    def idn(self):
+        return int(self.value("idn"))
 
-    def __init__(self, chrom, start, end, idn, score, strand, anchor, acceptor, pvalue):
-        self.chrom, self.start, self.end = chrom, start, end
-        self.idn, self.score, self.strand = idn, score, strand
-        self.anchor, self.acceptor = anchor, acceptor
-        self.information = []
-        self.pvalue = pvalue
+    @property
+    def score(self):
+        return int(self.value("score"))
+
+    @property
+    def strand(self):
+        return JunctionMap.STRANDS[self.value("strand")]
+
+    @property
+    def anchor(self):
+        return decode_motif(self.value("anchor"))
+
+    @property
+    def acceptor(self):
+        return decode_motif(self.value("acceptor"))
+
+    @property
+    def pvalue(self):
+        return float(self.value("pvalue"))
+
+    @property
+    def qvalue(self):
+        return float(self.value("qvalue"))
+
+    @property
+    def information(self):
+        """annotations of the read as [type, donors skipped, acceptors skipped, gene]"""
+        return self.junctionmap.information(self.index)
 
     @property
     def identifiers(self):
@@ -61,8 +160,8 @@ class Read:
 
     def __repr__(self):
         return (
-            fr"Read({self.chrom}, {self.start}, {self.end}, {self.idn}, "
-            fr"{self.score}, {self.strand}, {self.anchor}, {self.acceptor})"
+            rf"Read({self.chrom}, {self.start}, {self.end}, {self.idn}, "
+            rf"{self.score}, {self.strand}, {self.anchor}, {self.acceptor})"
         )
 
     def __str__(self):
@@ -83,12 +182,55 @@ class Read:
 
 
 class JunctionMap:
-    """build a class to store information of all junction reads"""
+    """build a class to store information of all junction reads
+
+    Junction reads are stored column-wise in NumPy arrays, strands and types
+    of slice are stored as codes of :attr:`STRANDS` and :attr:`TYPES`,
+    motifs are stored as codes return from :func:`encode_motif`.
+    Q-values are NaN until corrected by :meth:`JunctionDetector.fdr_correction`.
+    Annotations of junction reads live in a parallel table whose ``index``
+    column refers to rows of junction reads, genes are stored as codes of
+    :attr:`genes`.
+
+    :param chrom: chromosome of junction reads
+    :type chrom: str
+    """
+
+    STRANDS = ("+", "-", "N")
+    TYPES = ("DA", "NDA", "D", "A", "N")
+
+    COLUMNS = dict(
+        start=np.int64,
+        end=np.int64,
+        idn=np.int64,
+        score=np.uint32,
+        strand=np.int8,
+        anchor=np.uint16,
+        acceptor=np.uint16,
+        pvalue=np.float64,
+        qvalue=np.float64,
+    )
+    ANNOTATION_COLUMNS = dict(
+        index=np.int64,
+        type=np.int8,
+        dk=np.int32,
+        ak=np.int32,
+        gene=np.int32,
+    )
 
     def __init__(self, chrom):
         self.chrom = chrom
-        self._junctionList = []
+        self.columns = self._empty(self.COLUMNS)
+        self.genes = []
+        self._gene_codes = {}
+        self._annotations = self._empty(self.ANNOTATION_COLUMNS)
+        self._pending = []
         self.result = None
+        self.children = None
+
+    @staticmethod
+    def _empty(columns):
+        return {name: np.empty(0, dtype=dtype) for name, dtype in columns.items()}
 
     @classmethod
     def build(cls, chrom, data):
@@ -97,21 +239,72 @@ class JunctionMap:
         return new_instance
 
     def add_data(self, data):
-        self._junctionList = data
+        """replace junction reads by a list of :class:`Read`
+
+        :param data: views of junction reads, annotations are copied as well
+        :type data: list
+        """
+        self.columns = self._empty(self.COLUMNS)
+        self._annotations = self._empty(self.ANNOTATION_COLUMNS)
+        self._pending = []
+
+        data = list(data)
+        self.append(
+            **{name: [read.value(name) for read in data] for name in self.COLUMNS}
+        )
+        for index, read in enumerate(data):
+            for reads_type, dk, ak, gene in read.information:
+                self.add_annotation(index, self.TYPES.index(reads_type), dk, ak, gene)
 
     @property
     def data(self):
-        return self._junctionList
+        return list(self)
 
     def is_empty(self):
 
-        if len(self._junctionList):
+        if self.size():
             return False
         else:
             return True
 
     def size(self):
-        return len(self._junctionList)
+        return len(self.columns["start"])
+
+    def __len__(self):
+        return self.size()
+
+    def append(
+        self, start, end, idn, score, strand, anchor, acceptor, pvalue, qvalue=None
+    ):
+        """append junction reads column-wise
+
+        :param strand: codes of strands, see :attr:`STRANDS`
+        :type strand: numpy.array
+        :param anchor: codes of anchors, see :func:`encode_motif`
+        :type anchor: numpy.array
+        :param acceptor: codes of acceptors, see :func:`encode_motif`
+        :type acceptor: numpy.array
+        :param qvalue: q-values of junction reads. Defaults to NaN
+        :type qvalue: numpy.array
+        """
+        if qvalue is None:
+            qvalue = np.full(len(start), np.nan)
+
+        values = dict(
+            start=start,
+            end=end,
+            idn=idn,
+            score=score,
+            strand=strand,
+            anchor=anchor,
+            acceptor=acceptor,
+            pvalue=pvalue,
+            qvalue=qvalue,
+        )
+        for name, dtype in self.COLUMNS.items():
+            self.columns[name] = np.concatenate(
+                [self.columns[name], np.asarray(values[name], dtype=dtype).ravel()]
+            )
 
     def add_read(self, read):
         """add read to  junctionlist
@@ -119,7 +312,170 @@ class JunctionMap:
         :param read: instance from Read
         :type read: instance
         """
-        self._junctionList.append(read)
+        index = self.size()
+        self.append(**{name: [read.value(name)] for name in self.COLUMNS})
+        for reads_type, dk, ak, gene in read.information:
+            self.add_annotation(index, self.TYPES.index(reads_type), dk, ak, gene)
+
+    def add_annotation(self, index, types, donors_skipped, acceptors_skipped, genes):
+        """append annotations of junction reads
+
+        Arguments are broadcast against each other so that a batch of
+        annotations can be appended at once.
+
+        :param index: rows of annotated junction reads
+        :type index: numpy.array
+        :param types: codes of slice types, see :attr:`TYPES`
+        :type types: numpy.array
+        :param donors_skipped: number of skipped donors
+        :type donors_skipped: numpy.array
+        :param acceptors_skipped: number of skipped acceptors
+        :type acceptors_skipped: numpy.array
+        :param genes: gene ids of annotations
+        :type genes: list
+        """
+        if isinstance(genes, str):
+            genes = [genes]
+        gene_codes = [self.gene_code(gene) for gene in genes]
+
+        columns = np.broadcast_arrays(
+            index, types, donors_skipped, acceptors_skipped, gene_codes
+        )
+        self._pending.append(
+            {
+                name: np.asarray(column, dtype=dtype).ravel()
+                for (name, dtype), column in zip(
+                    self.ANNOTATION_COLUMNS.items(), columns
+                )
+            }
+        )
+
+    def gene_code(self, gene):
+        """code of gene id in :attr:`genes`, new gene id is added"""
+        if gene not in self._gene_codes:
+            self._gene_codes[gene] = len(self.genes)
+            self.genes.append(gene)
+        return self._gene_codes[gene]
+
+    @property
+    def annotations(self):
+        """table of annotations sorted by rows of junction reads
+
+        :return: columns of annotations
+        :rtype: dict
+        """
+        if self._pending:
+            chunks = [self._annotations, *self._pending]
+            annotations = {
+                name: np.concatenate([chunk[name] for chunk in chunks])
+                for name in self.ANNOTATION_COLUMNS
+            }
+            order = np.argsort(annotations["index"], kind="stable")
+            self._annotations = {
+                name: column[order] for name, column in annotations.items()
+            }
+            self._pending = []
+
+        return self._annotations
+
+    def information(self, index):
+        """annotations of one junction read
+
+        :param index: row of junction read
+        :type index: int
+        :return: list of [type, donors skipped, acceptors skipped, gene]
+        :rtype: list
+        """
+        annotations = self.annotations
+        lo, hi = np.searchsorted(annotations["index"], [index, index + 1])
+
+        return [
+            [self.TYPES[reads_type], int(dk), int(ak), self.genes[gene]]
+            for reads_type, dk, ak, gene in zip(
+                annotations["type"][lo:hi],
+                annotations["dk"][lo:hi],
+                annotations["ak"][lo:hi],
+                annotations["gene"][lo:hi],
+            )
+        ]
+
+    def table(self, cutoff=0):
+        """table of annotated junction reads built from columns at once
+
+        Every annotation of a junction read gives one row. Strands and types
+        of slice are categorical, so the cost of building the table does not
+        grow with the number of Python objects.
+
+        :param cutoff: only keep junction reads whose score is not less than cutoff
+        :type cutoff: int
+        :return: columns chrom, start, end, strand, score, qvalue, type, dk, ak, gene
+        :rtype: pandas.DataFrame
+        """
+        annotations = self.annotations
+        index = annotations["index"]
+        keep = self.columns["score"][index] >= cutoff
+        index = index[keep]
+
+        return pd.DataFrame(
+            dict(
+                chrom=self.chrom,
+                start=self.columns["start"][index],
+                end=self.columns["end"][index],
+                strand=pd.Categorical.from_codes(
+                    self.columns["strand"][index], categories=self.STRANDS
+                ),
+                score=self.columns["score"][index],
+                qvalue=self.columns["qvalue"][index],
+                type=pd.Categorical.from_codes(
+                    annotations["type"][keep], categories=self.TYPES
+                ),
+                dk=annotations["dk"][keep],
+                ak=annotations["ak"][keep],
+                gene=np.array(self.genes, dtype=object)[annotations["gene"][keep]],
+            ),
+            columns=[
+                "chrom",
+                "start",
+                "end",
+                "strand",
+                "score",
+                "qvalue",
+                "type",
+                "dk",
+                "ak",
+                "gene",
+            ],
+        )
+
+    def filter(self, mask):
+        """keep junction reads selected by a boolean mask as a new junction map
+
+        :param mask: whether to keep every junction read
+        :type mask: numpy.array
+        :return: instance from junctionmap
+        :rtype: instance
+        """
+        mask = np.asarray(mask, dtype=bool)
+        new_instance = type(self)(self.chrom)
+        new_instance.columns = {
+            name: column[mask] for name, column in self.columns.items()
+        }
+
+        annotations = self.annotations
+        keep = mask[annotations["index"]]
+        new_instance._annotations = {
+            name: column[keep] for name, column in annotations.items()
+        }
+        new_instance._annotations["index"] = (np.cumsum(mask) - 1)[
+            new_instance._annotations["index"]
+        ]
+        new_instance.genes = list(self.genes)
+        new_instance._gene_codes = dict(self._gene_codes)
+
+        return new_instance
+
+    def __getitem__(self, index):
+        return Read(self, index)
 
     def __contains__(self, read):
         """check if read is in junctionlist according to identifiers
@@ -129,12 +485,22 @@ class JunctionMap:
         :return: whether Read is in JunctionMap
         :rtype: bool
         """
-        return read in self._junctionList
+        return read.chrom == self.chrom and bool(
+            (
+                (self.columns["start"] == read.start)
+                & (self.columns["end"] == read.end)
+            ).any()
+        )
 
     def __iter__(self):
         """iterate every read in junctionlist"""
-        for item in self._junctionList:
-            yield item
+        for index in range(self.size()):
+            yield Read(self, index)
+
+    def __getstate__(self):
+        # pending annotations are merged before pickling
+        _ = self.annotations
+        return self.__dict__
 
     def __repr__(self):
         return f"ce_detector.detector.JunctionMap(chrom = {self.chrom})"
@@ -178,14 +544,17 @@ class JunctionDetector:
         dict(zip([("CT", "AC"), ("GT", "AT"), ("CT", "GC")], "---"))
     )  # negative site
 
-    PATTERN = re.compile(r"\d*?S*(\d+)M(\d+)N(\d+)M")
-
     def __init__(self, bam_file, reference, quality, output=None):
 
-        self.bam, self.reference = ps.AlignmentFile(bam_file), ps.FastaFile(reference)
+        self.bam_file, self.reference = bam_file, open_reference(reference)
 
         self.output, self.quality = output, quality
 
+    @property
+    def bam(self):
+        """handle of bam file, opened on first use so that merging never loads it"""
+        return open_alignment(self.bam_file)
+
     @staticmethod
     def check_strand(anchor, acceptor):
         """check type of strand
@@ -202,46 +571,359 @@ class JunctionDetector:
 
         return strand
 
+    @classmethod
+    def check_strands(cls, anchors, acceptors):
+        """check type of strands of junction reads at once
+
+        :param anchors: codes of anchors return from :func:`encode_motif`
+        :type anchors: numpy.array
+        :param acceptors: codes of acceptors return from :func:`encode_motif`
+        :type acceptors: numpy.array
+        :return: codes of strands, see :attr:`JunctionMap.STRANDS`
+        :rtype: numpy.array
+        """
+        site_keys = np.array(
+            [
+                encode_motif(anchor) << 16 | encode_motif(acceptor)
+                for anchor, acceptor in cls.SPLICE_SITE
+            ],
+            dtype=np.uint32,
+        )
+        site_strands = np.array(
+            [JunctionMap.STRANDS.index(strand) for strand in cls.SPLICE_SITE.values()],
+            dtype=np.int8,
+        )
+        order = np.argsort(site_keys)
+        site_keys, site_strands = site_keys[order], site_strands[order]
+
+        keys = np.asarray(anchors, dtype=np.uint32) << 16 | np.asarray(
+            acceptors, dtype=np.uint32
+        )
+        ind = np.searchsorted(site_keys, keys).clip(max=len(site_keys) - 1)
+
+        return np.where(
+            site_keys[ind] == keys,
+            site_strands[ind],
+            JunctionMap.STRANDS.index("N"),
+        ).astype(np.int8)
+
+    @staticmethod
+    def fetch_motifs(reference, ann_chrom, positions, chunk_size=SEQUENCE_CHUNK):
+        """fetch dinucleotides starting at positions of chromosome as codes
+
+        The reference is loaded chunk by chunk and only for chunks containing
+        positions, so the cost does not depend on the length of introns.
+
+        :param reference: handle of reference
+        :type reference: instance
+        :param ann_chrom: chromosome name in reference
+        :type ann_chrom: str
+        :param positions: 0-based positions of the first base of dinucleotides
+        :type positions: numpy.array
+        :param chunk_size: size of sequence loaded at once
+        :type chunk_size: int
+        :return: codes of dinucleotides return from :func:`encode_motif`
+        :rtype: numpy.array
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        codes = np.full(len(positions), encode_motif("NN"), dtype=np.uint16)
+
+        order = np.argsort(positions, kind="stable")
+        sorted_positions = positions[order]
+        valid = np.searchsorted(sorted_positions, 0)
+
+        for chunk in np.unique(sorted_positions[valid:] // chunk_size):
+            chunk_start = int(chunk) * chunk_size
+            lo, hi = np.searchsorted(
+                sorted_positions, [chunk_start, chunk_start + chunk_size]
+            )
+            # one more base for dinucleotides crossing the end of chunk
+            bases = np.frombuffer(
+                reference.fetch(
+                    reference=ann_chrom,
+                    start=chunk_start,
+                    end=chunk_start + chunk_size + 1,
+                )
+                .upper()
+                .encode("ascii"),
+                dtype=np.uint8,
+            ).astype(np.uint16)
+
+            offsets = sorted_positions[lo:hi] - chunk_start
+            inside = offsets + 1 < len(bases)
+            offsets = offsets[inside]
+            codes[order[lo:hi][inside]] = bases[offsets] << 8 | bases[offsets + 1]
+
+        return codes
+
+    @staticmethod
+    def splice_blocks(reference_start, cigartuples):
+        """parse every junction of a read and its flanking blocks from cigar tuples
+
+        A block is the number of aligned bases between two neighbouring
+        skipped regions (N) or the ends of the read, so reads with several
+        junctions get flanking blocks for each of them in a single pass.
+
+        :param reference_start: 0-based leftmost position of the read
+        :type reference_start: int
+        :param cigartuples: cigar of the read as (operation, length) tuples
+        :type cigartuples: list
+        :return: (start, end, block1, gap, block2) of every junction
+        :rtype: list
+        """
+        junctions = []
+        position, block, previous = reference_start, 0, None
+
+        for operation, length in cigartuples:
+            if operation in MATCH:
+                position += length
+                block += length
+            elif operation == ps.CDEL:
+                position += length
+            elif operation == ps.CREF_SKIP:
+                if previous is not None:
+                    junctions.append((*previous, block))
+                previous = (position, position + length, block, length)
+                position += length
+                block = 0
+
+        if previous is not None:
+            junctions.append((*previous, block))
+
+        return junctions
+
+    @classmethod
+    def count_junctions(cls, reads, quality):
+        """count junctions of reads while streaming through them once
+
+        Only counters of distinct junctions are kept so that memory does not
+        depend on the number of reads. Besides the support of every junction,
+        the blocks (block1, gap, block2) with the best block ratio among its
+        reads are tracked for computing p-values later.
+
+        :param reads: iterator of reads such as ``AlignmentFile.fetch``
+        :type reads: Iterable
+        :param quality: quality for filtering reads
+        :type quality: int
+        :return: support and best blocks of every junction keyed by (start, end)
+        :rtype: tuple[collections.Counter, dict]
+        """
+        junctions = Counter()
+        blocks = {}
+        n_reads = 0
+
+        for read in reads:
+            n_reads += 1
+
+            if read.is_unmapped or read.mapping_quality <= quality:
+                continue
+
+            # cheap check in htslib before walking cigar of unspliced reads
+            if not read.get_cigar_stats()[1][ps.CREF_SKIP]:
+                continue
+
+            for start, end, block1, gap, block2 in cls.splice_blocks(
+                read.reference_start, read.cigartuples
+            ):
+                junction = (start, end)
+                junctions[junction] += 1
+
+                longest = max(block1, block2)
+                block_ratio = min(block1, block2) / longest if longest else 0.0
+                if junction not in blocks or block_ratio > blocks[junction][0]:
+                    blocks[junction] = (block_ratio, block1, gap, block2)
+
+        metrics.add_counts(reads=n_reads, junctions=len(junctions))
+
+        return junctions, blocks
+
+    @staticmethod
+    def benjamini_hochberg(pvalues, alpha=0.05):
+        """correct p-values of every chromosome by Benjamini-Hochberg procedure
+
+        P-values of all chromosomes are ranked together as one family. A
+        p-value is rejected if it is not larger than the largest p-value
+        under its critical value ``alpha * rank / n``, and its q-value is the
+        smallest ``p * n / rank`` of itself and larger p-values.
+
+        :param pvalues: float arrays of p-values of every chromosome
+        :type pvalues: list
+        :param alpha: false discovery rate
+        :type alpha: float
+        :return: boolean masks of rejected p-values and q-values of every chromosome
+        :rtype: tuple[list, list]
+        """
+        sizes = [len(values) for values in pvalues]
+        flat = np.concatenate(
+            [np.empty(0), *(np.asarray(values, dtype=np.float64) for values in pvalues)]
+        )
+        n = len(flat)
+
+        order = np.argsort(flat, kind="mergesort")
+        ranked = flat[order]
+        ranks = np.arange(1, n + 1)
+
+        below = np.flatnonzero(ranked <= alpha * ranks / n)
+        rejected = ranks <= (below[-1] + 1 if len(below) else 0)
+
+        corrected = np.minimum.accumulate((ranked * n / ranks)[::-1])[::-1]
+
+        reject = np.empty(n, dtype=bool)
+        reject[order] = rejected
+        qvalues = np.empty(n, dtype=np.float64)
+        qvalues[order] = np.minimum(corrected, 1.0)
+
+        split_ind = np.cumsum(sizes)[:-1]
+        return np.split(reject, split_ind), np.split(qvalues, split_ind)
+
     @staticmethod
-    def fdr_correction(junctionmaps):
-        chroms = junctionmaps.keys()
-        junctionmaps_len = [jmap.size() for jmap in junctionmaps.values()]
-        split_ind = np.cumsum(junctionmaps_len)[:-1]
-        all_pvalues = np.array(
-            [read.pvalue for jmap in junctionmaps.values() for read in jmap]
+    def fdr_correction(junctionmaps, alpha=0.05):
+        """keep junction reads passing FDR and store their q-values
+
+        :param junctionmaps: chromosome to junction map
+        :type junctionmaps: dict
+        :param alpha: false discovery rate
+        :type alpha: float
+        :return: chromosome to filtered junction map with column qvalue
+        :rtype: dict
+        """
+        masks, qvalues = JunctionDetector.benjamini_hochberg(
+            [jmap.columns["pvalue"] for jmap in junctionmaps.values()], alpha
         )
-        cond, fdr = fdrcorrection(all_pvalues)
-        cond_pvalue = np.split(cond, split_ind)
 
-        for ind, chrom in enumerate(chroms):
-            data = np.array(junctionmaps[chrom].data)[cond_pvalue[ind]]
-            junctionmaps[chrom] = JunctionMap.build(chrom, data.tolist())
+        for (chrom, jmap), mask, qvalue in zip(
+            list(junctionmaps.items()), masks, qvalues
+        ):
+            jmap.columns["qvalue"] = qvalue
+            junctionmaps[chrom] = jmap.filter(mask)
 
         return junctionmaps
 
-    def get_pvalue(self, chrom, start, end):
+    @staticmethod
+    def get_pvalue(blocks):
+        """compute p-values of junctions at once in terms of their best blocks
 
-        jun_reads = self.bam.fetch(contig=chrom, start=start, end=end)
-        max_ratio = float("-inf")
-        max_info = tuple()
+        :param blocks: array of (block1, gap, block2) for every junction
+        :type blocks: numpy.array
+        :return: p-value of every junction
+        :rtype: numpy.array
+        """
+        blocks = np.asarray(blocks, dtype=np.float64).reshape(-1, 3)
 
-        for read in jun_reads:
+        R = np.minimum(blocks[:, 0], blocks[:, 2])
+        L = blocks[:, 1]
+        p_values = 1 - (1 - (1 / 4) ** R) ** (L - R + 1)
 
-            if "N" in read.cigarstring and read.mapping_quality > self.quality:
+        return p_values
 
-                block1, gap, block2 = map(
-                    int, self.PATTERN.search(read.cigarstring).groups()
-                )
-                block_ratio = min(block1, block2) / max(block1, block2)
-                if block_ratio > max_ratio:
-                    max_ratio = block_ratio
-                    max_info = (block1, gap, block2)
+    @staticmethod
+    def merge_junctions(parts):
+        """merge junctions counted in windows of one chromosome
+
+        Supports of a junction crossing the boundary of windows are summed and
+        its best blocks are kept. Parts should be ordered by window start so
+        that ties of block ratio are resolved as in a single sweep.
+
+        :param parts: (junctions, blocks) return from :meth:`count_junctions`
+        :type parts: Iterable
+        :return: merged support and best blocks of every junction
+        :rtype: tuple[collections.Counter, dict]
+        """
+        junctions = Counter()
+        blocks = {}
+
+        for part_junctions, part_blocks in parts:
+            junctions.update(part_junctions)
+
+            for junction, block in part_blocks.items():
+                if junction not in blocks or block[0] > blocks[junction][0]:
+                    blocks[junction] = block
+
+        return junctions, blocks
+
+    def sweep(self, chrom, start=None, end=None):
+        """count junctions of reads starting inside a window of chromosome
+
+        Reads are assigned to the window containing their leftmost position,
+        so every read is counted once when a chromosome is split into windows.
+
+        :param chrom: chromosome
+        :type chrom: str
+        :param start: 0-based start of window, defaults to the chromosome start
+        :type start: int
+        :param end: 0-based exclusive end of window, defaults to the chromosome end
+        :type end: int
+        :return: support and best blocks of every junction
+        :rtype: tuple[collections.Counter, dict]
+        """
+        reads = self.bam.fetch(contig=chrom, start=start, stop=end)
+
+        if start:
+            reads = (read for read in reads if read.reference_start >= start)
+
+        with measure("BAM sweep", chrom=chrom):
+            return self.count_junctions(reads, self.quality)
+
+    def build_junctionmap(
+        self,
+        reference,
+        chrom,
+        ann_chrom,
+        junction_regions,
+        junction_blocks,
+        idn,
+        junctionmap,
+    ):
+        """annotate slice site and p-value of counted junctions
+
+        :param reference: handle of reference
+        :type reference: instance
+        :param chrom: chromosome
+        :type chrom: str
+        :param ann_chrom: chromosome name in reference and annotation
+        :type ann_chrom: str
+        :param junction_regions: support of every junction
+        :type junction_regions: collections.Counter
+        :param junction_blocks: best blocks of every junction
+        :type junction_blocks: dict
+        :param idn: identifier of reads
+        :type idn: int
+        :param junctionmap: instance from junctionmap
+        :type junctionmap: instance
+        :return: instance from junctionmap
+        :rtype: instance
+        """
+        junction_regions = sorted(junction_regions.items())
+
+        with measure("P-value", chrom=chrom):
+            p_values = self.get_pvalue(
+                [junction_blocks[junction][1:] for junction, _ in junction_regions]
+            )
+
+        starts = np.array([start for (start, _), _ in junction_regions], dtype=np.int64)
+        ends = np.array([end for (_, end), _ in junction_regions], dtype=np.int64)
+
+        # annotate slice sites
+        with measure("Motif lookup", chrom=chrom):
+            anchors, acceptors = np.split(
+                self.fetch_motifs(
+                    reference, ann_chrom, np.concatenate([starts, ends - 2])
+                ),
+                2,
+            )
 
-        R = min(max_info[0], max_info[-1])
-        L = max_info[1]
-        p_value = 1 - (1 - (1 / 4) ** R) ** (L - R + 1)
+        junctionmap.append(
+            start=starts,
+            end=ends,
+            idn=np.arange(idn + 1, idn + 1 + len(junction_regions)),
+            score=[score for _, score in junction_regions],
+            strand=self.check_strands(anchors, acceptors),
+            anchor=anchors,
+            acceptor=acceptors,
+            pvalue=p_values,
+        )
 
-        return max_info, p_value
+        return junctionmap
 
     def worker(self, bam_file, reference, chrom, ann_chrom, quality, idn, junctionmap):
         """find junction reads and annotate slice site
@@ -264,32 +946,20 @@ class JunctionDetector:
         :rtype: instance
         """
         # detect junction reads
-        junction_regions = bam_file.find_introns(
-            [
-                r
-                for r in bam_file.fetch(contig=chrom)  # chrom
-                if r.mapping_quality > quality
-            ],
-        )
-
-        # annotate slice sites
-        for ((start, end), score) in junction_regions.items():
-            junction_bases = reference.fetch(
-                reference=ann_chrom,
-                start=start,
-                end=end,  # change chrom
-            )
-            anchor, acceptor = junction_bases[:2].upper(), junction_bases[-2:].upper()
-            strand = self.check_strand(anchor, acceptor)
-            _, p_value = self.get_pvalue(chrom, start, end)
-            read = Read(
-                chrom, start, end, idn + 1, score, strand, anchor, acceptor, p_value
+        with measure("BAM sweep", chrom=chrom):
+            junction_regions, junction_blocks = self.count_junctions(
+                bam_file.fetch(contig=chrom), quality
             )
-            junctionmap.add_read(read)
 
-            idn += 1
-
-        return junctionmap
+        return self.build_junctionmap(
+            reference,
+            chrom,
+            ann_chrom,
+            junction_regions,
+            junction_blocks,
+            idn,
+            junctionmap,
+        )
 
     @timethis(name="Junction detector", message=" ")
     def run(self, chrom, ann_chrom, logger, verbose=False):
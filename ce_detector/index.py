@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""compiled index of gene spans and introns for annotating junction reads
+
+The index is compiled once from a gffutils database and stored as a
+directory of ``.npy`` files which are memory-mapped when loaded, so
+annotation does not need any SQLite query.
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+
+
+def expand_ranges(lo, hi):
+    """expand range [lo, hi) of every row into pairs of (row, position)
+
+    :param lo: start of range of every row
+    :type lo: numpy.array
+    :param hi: exclusive end of range of every row
+    :type hi: numpy.array
+    :return: rows and positions of all pairs ordered by row
+    :rtype: tuple[numpy.array, numpy.array]
+    """
+    lo = np.asarray(lo, dtype=np.int64)
+    counts = np.clip(np.asarray(hi, dtype=np.int64) - lo, 0, None)
+
+    rows = np.repeat(np.arange(len(lo)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return rows, lo[rows] + offsets
+
+
+def derive_introns(db, gene):
+    """derive unique introns of a gene from its transcripts and exons
+
+    :param db: database of annotation file
+    :type db: ``gffutils.FeatureDB``
+    :param gene: gene feature or gene id
+    :type gene: ``gffutils.Feature`` or str
+    :return: array of (start, end) of unique introns, 1-based and inclusive
+    :rtype: numpy.array
+    """
+    introns = []
+
+    for transcript in db.children(
+        gene,
+        level=1,
+        featuretype=("primary_transcript", "transcript", "mRNA"),
+    ):  # mRNA may drop out
+
+        # find all position of introns for every gene known junctions
+        for junction in db.interfeatures(
+            db.children(
+                transcript,
+                level=1,
+                featuretype="exon",
+                order_by="start",
+            ),
+            new_featuretype="intron",
+        ):
+            introns.append([junction.start, junction.end])
+
+    if not introns:
+        return np.empty((0, 2), dtype=np.int64)
+
+    return np.unique(np.array(introns, dtype=np.int64), axis=0)
+
+
+def overlap_pairs(starts, ends, gene_starts, gene_ends):
+    """find every pair of junction and gene overlapping each other at once
+
+    Genes must be sorted by start. Candidates of a junction are bounded by
+    ``searchsorted`` on starts of genes and on the running maximum of ends
+    of genes, then filtered by the ends of genes.
+
+    :param starts: starts of junctions
+    :type starts: numpy.array
+    :param ends: ends of junctions
+    :type ends: numpy.array
+    :param gene_starts: starts of genes sorted in ascending order
+    :type gene_starts: numpy.array
+    :param gene_ends: ends of genes
+    :type gene_ends: numpy.array
+    :return: (junction index, gene index) of overlapping pairs ordered by junction
+    :rtype: tuple[numpy.array, numpy.array]
+    """
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    gene_starts, gene_ends = np.asarray(gene_starts), np.asarray(gene_ends)
+
+    if not len(gene_starts):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # genes before lo end before the junction, genes from hi start after it
+    lo = np.searchsorted(np.maximum.accumulate(gene_ends), starts, side="left")
+    hi = np.searchsorted(gene_starts, ends, side="right")
+
+    junction_idx, gene_idx = expand_ranges(lo, hi)
+    keep = gene_ends[gene_idx] >= starts[junction_idx]
+
+    return junction_idx[keep], gene_idx[keep]
+
+
+def get_seqids(database):
+    """chromosomes of annotation file
+
+    :param database: path of database of annotation file or its index
+    :type database: str
+    :return: chromosomes in annotation file
+    :rtype: set
+    """
+    if AnnotationIndex.is_index(database):
+        return set(np.load(os.path.join(database, "seqids.npy")).tolist())
+
+    import gffutils
+
+    return set(gffutils.FeatureDB(database).seqids())
+
+
+class AnnotationIndex:
+    """gene spans and unique introns of every chromosome stored in NumPy arrays
+
+    Genes of a chromosome are stored contiguously and sorted by start,
+    ``seqid_offsets`` gives the range of genes of every chromosome.
+    Introns of a gene are stored contiguously as well, ``intron_offsets``
+    gives the range of introns of every gene. Genes without introns are
+    dropped as they can not be used to annotate junction reads.
+    """
+
+    FIELDS = (
+        "seqids",
+        "seqid_offsets",
+        "gene_ids",
+        "gene_starts",
+        "gene_ends",
+        "intron_offsets",
+        "intron_starts",
+        "intron_ends",
+    )
+
+    def __init__(
+        self,
+        seqids,
+        seqid_offsets,
+        gene_ids,
+        gene_starts,
+        gene_ends,
+        intron_offsets,
+        intron_starts,
+        intron_ends,
+    ):
+        self.seqids, self.seqid_offsets = seqids, seqid_offsets
+        self.gene_ids = gene_ids
+        self.gene_starts, self.gene_ends = gene_starts, gene_ends
+        self.intron_offsets = intron_offsets
+        self.intron_starts, self.intron_ends = intron_starts, intron_ends
+
+        self._seqid_index = {seqid: ind for ind, seqid in enumerate(seqids.tolist())}
+
+    def __repr__(self):
+        return f"AnnotationIndex({len(self.seqids)} seqids, {len(self.gene_ids)} genes)"
+
+    @classmethod
+    def from_db(cls, database, seqids=None):
+        """compile index from database of annotation file
+
+        :param database: database of annotation file or its path
+        :type database: str or ``gffutils.FeatureDB``
+        :param seqids: only compile genes of these chromosomes. Defaults to all
+        :type seqids: Iterable
+        :return: instance of :class:`AnnotationIndex`
+        :rtype: instance
+        """
+        import gffutils
+
+        db = (
+            database
+            if isinstance(database, gffutils.FeatureDB)
+            else gffutils.FeatureDB(database)
+        )
+        seqids = None if seqids is None else set(seqids)
+
+        genes = {}
+        for gene in db.features_of_type("gene", order_by=("seqid", "start", "end")):
+            if seqids is not None and gene.seqid not in seqids:
+                continue
+
+            introns = derive_introns(db, gene)
+            # drop gene with only one exon in terms of number of intron
+            if len(introns):
+                genes.setdefault(gene.seqid, []).append(
+                    (gene.id, gene.start, gene.end, introns)
+                )
+
+        return cls.from_genes(genes)
+
+    @classmethod
+    def from_genes(cls, genes):
+        """build index from genes of every chromosome
+
+        :param genes: chromosome to list of (gene id, start, end, introns)
+            sorted by start
+        :type genes: dict
+        :return: instance of :class:`AnnotationIndex`
+        :rtype: instance
+        """
+        records = [record for seqid in genes for record in genes[seqid]]
+        introns = [record[3] for record in records]
+
+        return cls(
+            seqids=np.array(list(genes), dtype=str),
+            seqid_offsets=np.cumsum([0] + [len(genes[seqid]) for seqid in genes]),
+            gene_ids=np.array([record[0] for record in records], dtype=str),
+            gene_starts=np.array([record[1] for record in records], dtype=np.int64),
+            gene_ends=np.array([record[2] for record in records], dtype=np.int64),
+            intron_offsets=np.cumsum([0] + [len(intron) for intron in introns]),
+            intron_starts=np.concatenate(
+                [intron[:, 0] for intron in introns] + [np.empty(0, np.int64)]
+            ),
+            intron_ends=np.concatenate(
+                [intron[:, 1] for intron in introns] + [np.empty(0, np.int64)]
+            ),
+        )
+
+    def save(self, path):
+        """write every array of index into a directory
+
+        :param path: directory of index
+        :type path: str
+        """
+        os.makedirs(path, exist_ok=True)
+
+        for name in self.FIELDS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """load index written by :meth:`save`
+
+        :param path: directory of index
+        :type path: str
+        :param mmap_mode: mode to memory-map arrays, see ``numpy.load``
+        :type mmap_mode: str
+        :return: instance of :class:`AnnotationIndex`
+        :rtype: instance
+        """
+        return cls(
+            **{
+                name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                for name in cls.FIELDS
+            }
+        )
+
+    @staticmethod
+    def is_index(path):
+        """check whether path is a directory of index
+
+        :param path: path of database or index
+        :type path: str
+        :rtype: bool
+        """
+        return os.path.isfile(os.path.join(path, "gene_ids.npy"))
+
+    def genes(self, seqid):
+        """range of genes of a chromosome
+
+        :param seqid: chromosome in annotation file
+        :type seqid: str
+        :return: slice of gene arrays
+        :rtype: slice
+        """
+        ind = self._seqid_index.get(seqid)
+
+        if ind is None:
+            return slice(0, 0)
+
+        return slice(int(self.seqid_offsets[ind]), int(self.seqid_offsets[ind + 1]))
+
+    def introns(self, gene):
+        """unique introns of a gene
+
+        :param gene: index of gene
+        :type gene: int
+        :return: array of (start, end) of introns, 1-based and inclusive
+        :rtype: numpy.array
+        """
+        lo, hi = self.intron_offsets[gene], self.intron_offsets[gene + 1]
+
+        return np.column_stack([self.intron_starts[lo:hi], self.intron_ends[lo:hi]])
+
+
+@lru_cache(maxsize=8)
+def _open_index(path, mtime):
+    return AnnotationIndex.load(path)
+
+
+def open_index(path):
+    """load index once for every process and share it across tasks
+
+    Arrays are memory-mapped read-only, so the index is safe to share by
+    threads. An index rewritten at the same path is loaded again.
+
+    :param path: directory of index
+    :type path: str
+    :return: instance of :class:`AnnotationIndex`
+    :rtype: instance
+    """
+    path = os.path.realpath(path)
+    mtime = os.stat(os.path.join(path, "gene_ids.npy")).st_mtime_ns
+
+    return _open_index(path, mtime)
@@ -8,9 +8,53 @@
 @file: main.py
 @time: 2021/1/29 7:30 AM
 """
+import itertools
+import os
+from collections import Counter
+from concurrent import futures
+
+import pandas as pd
+import pysam as ps
+
+from . import metrics
 from .annotator import Annotator
 from .detector import JunctionDetector
+from .detector import JunctionMap
+from .detector import open_reference
 from .scanner import Scanner
+from .scanner import find_ce
+from .utils import get_windows
+from .utils import measure
+
+
+def get_contigs(bam, seqids, alias):
+    """discover chromosomes to detect from header and index of bam file
+
+    A chromosome in bam file is renamed by alias table, or kept as it is
+    if absent in the table. Chromosomes missing in annotation file or
+    without mapped reads are skipped.
+
+    :param bam: bam file with index
+    :type bam: str
+    :param seqids: chromosomes in annotation file
+    :type seqids: set
+    :param alias: chromosome in bam mapping to chromosome in annotation
+    :type alias: dict
+    :return: chromosome in bam mapping to (chromosome in annotation, number of
+        mapped reads) in order of bam header
+    :rtype: dict
+    """
+    with ps.AlignmentFile(bam) as bam_file:
+        mapped = {
+            stats.contig: stats.mapped for stats in bam_file.get_index_statistics()
+        }
+        contigs = bam_file.references
+
+    return {
+        contig: (alias.get(contig, contig), mapped[contig])
+        for contig in contigs
+        if mapped.get(contig) and alias.get(contig, contig) in seqids
+    }
 
 
 def detection(chrom, ann_chrom, bam, reference, quality, verbose):
@@ -24,7 +68,160 @@ def detection(chrom, ann_chrom, bam, reference, quality, verbose):
     return junctionmap
 
 
-def main(junctionmap, gffdb, cutoff, verbose):
+def detection_window(chrom, start, end, bam, reference, quality, verbose):
+    """count junctions of reads starting in a window of chromosome
+
+    :return: support and best blocks of every junction
+    :rtype: tuple
+    """
+    detector = JunctionDetector(
+        bam,
+        reference,
+        quality,
+    )
+
+    with measure("Junction detector window", chrom=chrom):
+        return detector.sweep(chrom, start, end)
+
+
+def merge_detection(chrom, ann_chrom, parts, bam, reference, quality, verbose):
+    """merge junctions of all windows of chromosome and build junction map
+
+    :param parts: results of :func:`detection_window` ordered by window start
+    :type parts: list
+    :return: instance from :class:`ce_detector.detector.JunctionMap`
+    :rtype: instance
+    """
+    # only genome reference is needed, bam file is never opened
+    detector = JunctionDetector(bam, reference, quality)
+
+    with measure("Junction merger", chrom=chrom):
+        junction_regions, junction_blocks = detector.merge_junctions(parts)
+
+        junctionmap = detector.build_junctionmap(
+            open_reference(reference),
+            chrom,
+            ann_chrom,
+            junction_regions,
+            junction_blocks,
+            0,
+            JunctionMap(chrom),
+        )
+        metrics.add_counts(junctions=junctionmap.size())
+
+    return junctionmap
+
+
+def iter_detection(
+    executor,
+    chroms,
+    bam,
+    reference,
+    quality,
+    window_size,
+    verbose,
+    counts=None,
+    max_pending=None,
+):
+    """detect junction reads of chromosomes split into windows
+
+    Chromosomes are detected heaviest first so that big chromosomes do not
+    become stragglers, and windows of a chromosome are submitted in order.
+    A chromosome weighs its mapped reads if param:`counts` is given, or its
+    length otherwise. Only param:`max_pending` windows are submitted at a
+    time, and more are fed as they finish. Once all windows of a chromosome
+    are finished, they are merged into its junction map by another task, so
+    merging and annotation of a chromosome are queued ahead of windows of
+    later chromosomes instead of behind the whole genome.
+
+    :param executor: executor to submit tasks
+    :type executor: ``concurrent.futures.Executor``
+    :param chroms: chromosome in bam mapping to chromosome in reference
+    :type chroms: dict
+    :param window_size: size of window, a chromosome is not split if not positive
+    :type window_size: int
+    :param counts: number of mapped reads of every chromosome. Defaults to None
+    :type counts: dict
+    :param max_pending: bound of windows submitted at a time. Defaults to
+        workers of param:`executor` or number of CPUs
+    :type max_pending: int
+    :return: iterator of (chromosome, junction map) in order of completion
+    :rtype: Iterator
+    """
+    with ps.AlignmentFile(bam) as bam_file:
+        lengths = {chrom: bam_file.get_reference_length(chrom) for chrom in chroms}
+
+    def weight(chrom):
+        return lengths[chrom] if counts is None else counts[chrom]
+
+    windows = [
+        (chrom, start, end)
+        for chrom in sorted(chroms, key=weight, reverse=True)
+        for start, end in get_windows(lengths[chrom], window_size)
+    ]
+    # windows of chromosome left to finish
+    remaining = Counter(chrom for chrom, _, _ in windows)
+    parts = {chrom: {} for chrom in remaining}
+
+    windows = iter(windows)
+    max_pending = max(
+        max_pending or getattr(executor, "_max_workers", None) or os.cpu_count(), 1
+    )
+
+    tasks = {}
+
+    def submit_windows():
+        pending = sum(start is not None for _, start in tasks.values())
+
+        for chrom, start, end in itertools.islice(windows, max_pending - pending):
+            future = metrics.submit(
+                executor,
+                detection_window,
+                chrom,
+                start,
+                end,
+                bam,
+                reference,
+                quality,
+                verbose,
+            )
+            tasks[future] = (chrom, start)
+
+    submit_windows()
+
+    while tasks:
+        done, _ = futures.wait(tasks, return_when=futures.FIRST_COMPLETED)
+
+        for future in done:
+            chrom, start = tasks.pop(future)
+
+            # junction map of a merged chromosome
+            if start is None:
+                yield chrom, future.result()
+                continue
+
+            parts[chrom][start] = future.result()
+            remaining[chrom] -= 1
+
+            if not remaining[chrom]:
+                chrom_parts = parts.pop(chrom)
+                future = metrics.submit(
+                    executor,
+                    merge_detection,
+                    chrom,
+                    chroms[chrom],
+                    [chrom_parts[start] for start in sorted(chrom_parts)],
+                    bam,
+                    reference,
+                    quality,
+                    verbose,
+                )
+                tasks[future] = (chrom, None)
+
+        submit_windows()
+
+
+def main(junctionmap, gffdb, cutoff, verbose, cache=None, chroms=None):
     """
     :param junctionmap:
     :type junctionmap:
@@ -34,14 +231,171 @@ def main(junctionmap, gffdb, cutoff, verbose):
     :type cutoff:
     :param verbose:
     :type verbose:
+    :param cache: cache of introns derived from database
+    :type cache: :class:`ce_detector.cache.IntronCache`
+    :param chroms: chromosome in bam mapping to chromosome in annotation
+    :type chroms: dict
     :return:
     :rtype:
     """
-    annotator = Annotator(gffdb)
-    scanner = Scanner(cutoff=cutoff)
+    junctionmap = annotation(junctionmap, gffdb, verbose, cache, chroms)
+
+    return scanning(junctionmap, cutoff, verbose)
+
+
+def annotation(junctionmap, gffdb, verbose, cache=None, chroms=None):
+    """annotate junction reads of a chromosome
+
+    :param cache: cache of introns derived from database
+    :type cache: :class:`ce_detector.cache.IntronCache`
+    :param chroms: chromosome in bam mapping to chromosome in annotation
+    :type chroms: dict
+    :return: instance from :class:`ce_detector.detector.JunctionMap`
+    :rtype: instance
+    """
+    annotator = Annotator(gffdb, cache=cache, chroms=chroms)
 
     if not junctionmap.is_empty():
         junctionmap = annotator.run(junctionmap=junctionmap, verbose=verbose)
-        junctionmap = scanner.run(junctionmap, verbose=verbose)
 
     return junctionmap
+
+
+def scanning(junctionmap, cutoff, verbose):
+    """scan cryptic exons of a chromosome based on annotated junction reads
+
+    Empty junction map is scanned as well, so that every chromosome gets
+    a table of cryptic exons with the same columns.
+
+    :return: instance from :class:`ce_detector.detector.JunctionMap`
+    :rtype: instance
+    """
+    scanner = Scanner(cutoff=cutoff)
+
+    return scanner.run(junctionmap, verbose=verbose)
+
+
+def pipeline(
+    executor,
+    chroms,
+    bam,
+    reference,
+    quality,
+    window_size,
+    gffdb,
+    cutoff,
+    verbose,
+    cache=None,
+    counts=None,
+    junction_cache=None,
+):
+    """detect, annotate and scan chromosomes without waiting between stages
+
+    A chromosome is annotated as soon as its junction map is built, while
+    other chromosomes are still detected. Only Benjamini-Hochberg correction
+    needs p-values of all chromosomes, so junction reads are filtered by FDR
+    once every chromosome is annotated, and then scanned. Junction maps
+    found in param:`junction_cache` are annotated without detection.
+
+    :param executor: executor to submit tasks
+    :type executor: ``concurrent.futures.Executor``
+    :param chroms: chromosome in bam mapping to chromosome in reference and annotation
+    :type chroms: dict
+    :param counts: number of mapped reads of every chromosome. Defaults to None
+    :type counts: dict
+    :param junction_cache: cache of detected junction maps. Defaults to None
+    :type junction_cache: :class:`ce_detector.cache.JunctionCache`
+    :return: chromosome to junction map with cryptic exons in order of param:`chroms`
+    :rtype: dict
+    """
+    keys, cached = {}, {}
+    if junction_cache is not None:
+        for chrom, ann_chrom in chroms.items():
+            keys[chrom] = junction_cache.key(bam, reference, chrom, ann_chrom, quality)
+            junctionmap = junction_cache.get(keys[chrom], chrom)
+            if junctionmap is not None:
+                cached[chrom] = junctionmap
+
+    tasks = {}
+    for chrom, junctionmap in cached.items():
+        future = metrics.submit(
+            executor, annotation, junctionmap, gffdb, verbose, cache, chroms
+        )
+        tasks[future] = chrom
+
+    for chrom, junctionmap in iter_detection(
+        executor,
+        {chrom: chroms[chrom] for chrom in chroms if chrom not in cached},
+        bam,
+        reference,
+        quality,
+        window_size,
+        verbose,
+        counts,
+    ):
+        if junction_cache is not None:
+            junction_cache.put(keys[chrom], junctionmap)
+
+        future = metrics.submit(
+            executor, annotation, junctionmap, gffdb, verbose, cache, chroms
+        )
+        tasks[future] = chrom
+
+    junctionmaps = {}
+    for future in futures.as_completed(tasks):
+        junctionmaps[tasks[future]] = future.result()
+
+    junctionmaps = JunctionDetector.fdr_correction(
+        {chrom: junctionmaps[chrom] for chrom in chroms}
+    )
+
+    tasks = {
+        metrics.submit(executor, scanning, junctionmap, cutoff, verbose): chrom
+        for chrom, junctionmap in junctionmaps.items()
+    }
+    for future in futures.as_completed(tasks):
+        junctionmaps[tasks[future]] = future.result()
+
+    return junctionmaps
+
+
+def collect_result(junctionmaps):
+    """gather cryptic exons of all chromosomes
+
+    :param junctionmaps: chromosome to junction map
+    :type junctionmaps: dict
+    :return: cryptic exons in order of param:`junctionmaps`
+    :rtype: pandas.DataFrame
+    """
+    results = [
+        jmap.result
+        for jmap in junctionmaps.values()
+        if isinstance(jmap.result, pd.DataFrame)
+    ]
+
+    if not results:
+        # empty table with the same columns
+        return find_ce(JunctionMap("").table())
+
+    return pd.concat(results)
+
+
+def collect_children(junctionmaps):
+    """gather long-format children of cryptic exons of all chromosomes
+
+    :param junctionmaps: chromosome to junction map
+    :type junctionmaps: dict
+    :return: children in order of param:`junctionmaps`
+    :rtype: pandas.DataFrame
+    """
+    children = [
+        jmap.children
+        for jmap in junctionmaps.values()
+        if isinstance(jmap.children, pd.DataFrame)
+    ]
+
+    if not children:
+        # empty table with the same columns
+        return find_ce(JunctionMap("").table(), long=True)[1]
+
+    return pd.concat(children, ignore_index=True)
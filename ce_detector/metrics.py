@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""registry of performance metrics of stages
+
+Every finished stage gives a record of its chromosome, wall time, CPU time,
+memory and numbers of processed items such as reads, junctions and genes.
+
+Memory of a stage is ``rss_delta_mb``, the change of resident set size of
+its process from start to end of the stage, which includes allocations of
+other threads running meanwhile. ``peak_rss_mb`` is the high-water mark of
+the whole process when the stage ends, not a property of the stage.
+Records are appended as JSON lines to a file of every process inside the
+directory given by ``$CE_DETECTOR_METRICS_DIR``, so records of worker
+processes are gathered by the main process without sending them back with
+results. Nothing is recorded if the directory is not set.
+
+Records are written as a JSON report of summaries by
+:func:`write_report`, or as a Chrome Trace Event file by :func:`write_trace`
+to be viewed in Perfetto or chrome://tracing.
+"""
+import json
+import os
+import resource
+import shutil
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from . import profiler
+
+# environment variable of directory of records, inherited by worker processes
+METRICS_DIR = "CE_DETECTOR_METRICS_DIR"
+
+# fields of every record besides labels
+RECORD_FIELDS = (
+    "stage",
+    "chrom",
+    "pid",
+    "thread",
+    "start",
+    "wall",
+    "cpu",
+    "rss_delta_mb",
+    "peak_rss_mb",
+    "counts",
+)
+
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(directory):
+    """record metrics of this process and its future worker processes
+
+    :param directory: directory of records
+    :type directory: str
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.environ[METRICS_DIR] = directory
+
+
+def disable():
+    """stop recording metrics"""
+    os.environ.pop(METRICS_DIR, None)
+
+
+def get_directory():
+    """directory of records, None if metrics are disabled"""
+    return os.environ.get(METRICS_DIR) or None
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """peak resident set size in MB
+
+    :param who: ``resource.RUSAGE_SELF`` for current process, or
+        ``resource.RUSAGE_CHILDREN`` for the largest waited child process
+    :type who: int
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def current_rss():
+    """current resident set size of current process in MB
+
+    Falls back to :func:`peak_rss` where ``/proc`` is not available.
+    """
+    try:
+        with open("/proc/self/statm") as handle:
+            pages = int(handle.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return peak_rss()
+
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+
+
+def _stack(name):
+    if not hasattr(_local, name):
+        setattr(_local, name, [])
+    return getattr(_local, name)
+
+
+@contextmanager
+def labelled(**labels):
+    """attach labels such as sample to records of stages run inside"""
+    stack = _stack("labels")
+    stack.append(labels)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def get_labels():
+    """labels of current thread"""
+    labels = {}
+    for layer in _stack("labels"):
+        labels.update(layer)
+    return labels
+
+
+def with_labels(labels, func, *args, **kwargs):
+    """call function with labels, used as task of executors
+
+    The task is profiled if :mod:`ce_detector.profiler` is enabled.
+    """
+    with labelled(**labels):
+        return profiler.call(func, *args, **kwargs)
+
+
+def submit(executor, func, *args, labels=None, **kwargs):
+    """submit task to executor so that its records carry labels
+
+    :param executor: executor to submit tasks
+    :type executor: ``concurrent.futures.Executor``
+    :param labels: labels of records of task. Defaults to labels of current thread
+    :type labels: dict
+    :return: future of task
+    :rtype: ``concurrent.futures.Future``
+    """
+    labels = get_labels() if labels is None else labels
+    return executor.submit(with_labels, labels, func, *args, **kwargs)
+
+
+@contextmanager
+def counting():
+    """collect numbers of processed items of a stage, see :func:`add_counts`"""
+    stack = _stack("counts")
+    stack.append(Counter())
+    try:
+        yield stack[-1]
+    finally:
+        stack.pop()
+
+
+def add_counts(**counts):
+    """add numbers of processed items to every running stage of current thread
+
+    Stages nested in another one, such as p-value inside junction detector,
+    are counted by the enclosing stage as well.
+    """
+    for counter in _stack("counts"):
+        counter.update(counts)
+
+
+def record(stage, timer, chrom=None, counts=None, rss=None):
+    """record a finished stage
+
+    :param stage: name of stage
+    :type stage: str
+    :param timer: timer of stage
+    :type timer: :class:`ce_detector.utils.Timer`
+    :param chrom: chromosome processed by stage
+    :type chrom: str
+    :param counts: numbers of processed items
+    :type counts: dict
+    :param rss: resident set size in MB at start of stage, see :func:`current_rss`
+    :type rss: float
+    """
+    directory = get_directory()
+    if directory is None:
+        return
+
+    entry = dict(
+        stage=stage,
+        chrom=chrom,
+        **get_labels(),
+        pid=os.getpid(),
+        thread=threading.get_ident(),
+        start=timer.started,
+        wall=timer.elapsed,
+        cpu=timer.cpu_elapsed,
+        rss_delta_mb=None if rss is None else current_rss() - rss,
+        peak_rss_mb=peak_rss(),
+        counts={name: int(value) for name, value in (counts or {}).items()},
+    )
+
+    with _lock, open(os.path.join(directory, f"{os.getpid()}.jsonl"), "a") as handle:
+        handle.write(f"{json.dumps(entry)}\n")
+
+
+def collect(directory=None):
+    """records of all processes ordered by start
+
+    :param directory: directory of records. Defaults to :func:`get_directory`
+    :type directory: str
+    :return: records
+    :rtype: list
+    """
+    directory = directory or get_directory()
+    records = []
+
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".jsonl"):
+            with open(os.path.join(directory, name)) as handle:
+                records.extend(json.loads(line) for line in handle if line.strip())
+
+    return sorted(records, key=lambda entry: entry["start"])
+
+
+def summarize(records, keys):
+    """aggregate records grouped by keys
+
+    Wall time, CPU time and counts are summed, RSS change of stage and
+    process-wide peak RSS are the maximum, throughput is every count divided
+    by wall time.
+
+    :param records: records return from :func:`collect`
+    :type records: list
+    :param keys: fields of records to group by, such as ("stage",)
+    :type keys: tuple
+    :return: aggregated metrics of every group
+    :rtype: list
+    """
+    groups = {}
+
+    for entry in records:
+        group = tuple(entry.get(key) for key in keys)
+        summary = groups.setdefault(
+            group,
+            dict(
+                zip(keys, group),
+                tasks=0,
+                wall=0.0,
+                cpu=0.0,
+                rss_delta_mb=None,
+                peak_rss_mb=0.0,
+                counts=Counter(),
+            ),
+        )
+        summary["tasks"] += 1
+        summary["wall"] += entry["wall"]
+        summary["cpu"] += entry["cpu"]
+        summary["rss_delta_mb"] = max(
+            (
+                delta
+                for delta in (summary["rss_delta_mb"], entry.get("rss_delta_mb"))
+                if delta is not None
+            ),
+            default=None,
+        )
+        summary["peak_rss_mb"] = max(summary["peak_rss_mb"], entry["peak_rss_mb"])
+        summary["counts"].update(entry["counts"])
+
+    for summary in groups.values():
+        summary["counts"] = dict(summary["counts"])
+        summary["throughput"] = {
+            name: value / summary["wall"] if summary["wall"] else None
+            for name, value in summary["counts"].items()
+        }
+
+    return list(groups.values())
+
+
+def write_report(output, directory=None):
+    """write records and their summaries as a JSON report
+
+    :param output: filename of report
+    :type output: str
+    :param directory: directory of records. Defaults to :func:`get_directory`
+    :type directory: str
+    :return: report
+    :rtype: dict
+    """
+    records = collect(directory)
+    labels = sorted({key for entry in records for key in entry} - set(RECORD_FIELDS))
+
+    report = dict(
+        stages=summarize(records, ("stage",)),
+        chromosomes=summarize(records, (*labels, "chrom", "stage")),
+        records=records,
+    )
+
+    with open(output, "w") as handle:
+        json.dump(report, handle, indent=2)
+
+    return report
+
+
+def trace_events(records, main_pid=None):
+    """convert records to Chrome Trace Events
+
+    Every record gives a complete event, holding begin and duration of the
+    stage in microseconds relative to the earliest record, on track of its
+    process and thread. Chromosome, labels, CPU time and counts are kept in
+    arguments of events. Processes and threads are named by metadata events.
+
+    :param records: records return from :func:`collect`
+    :type records: list
+    :param main_pid: pid of main process. Defaults to current process
+    :type main_pid: int
+    :return: trace events
+    :rtype: list
+    """
+    main_pid = os.getpid() if main_pid is None else main_pid
+    origin = min((entry["start"] for entry in records), default=0.0)
+    events, threads = [], {}
+
+    for entry in records:
+        pid = entry["pid"]
+        if pid not in threads:
+            threads[pid] = {}
+            events.append(
+                dict(
+                    name="process_name",
+                    ph="M",
+                    pid=pid,
+                    tid=0,
+                    args=dict(
+                        name="ce_detector" if pid == main_pid else f"worker {pid}"
+                    ),
+                )
+            )
+
+        # thread idents are long, threads are numbered per process instead
+        tid = threads[pid].setdefault(entry["thread"], len(threads[pid]) + 1)
+
+        args = {key: value for key, value in entry.items() if key not in RECORD_FIELDS}
+        events.append(
+            dict(
+                name=entry["stage"],
+                cat="stage",
+                ph="X",
+                ts=round((entry["start"] - origin) * 1e6, 3),
+                dur=round(entry["wall"] * 1e6, 3),
+                pid=pid,
+                tid=tid,
+                args=dict(
+                    chrom=entry["chrom"],
+                    **args,
+                    cpu=entry["cpu"],
+                    rss_delta_mb=entry.get("rss_delta_mb"),
+                    peak_rss_mb=entry["peak_rss_mb"],
+                    **entry["counts"],
+                ),
+            )
+        )
+
+    for pid, idents in threads.items():
+        events.extend(
+            dict(
+                name="thread_name",
+                ph="M",
+                pid=pid,
+                tid=tid,
+                args=dict(name=f"thread {tid}"),
+            )
+            for tid in idents.values()
+        )
+
+    return events
+
+
+def write_trace(output, directory=None):
+    """write records as a Chrome Trace Event file
+
+    :param output: filename of trace
+    :type output: str
+    :param directory: directory of records. Defaults to :func:`get_directory`
+    :type directory: str
+    :return: trace events
+    :rtype: list
+    """
+    events = trace_events(collect(directory))
+
+    with open(output, "w") as handle:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), handle)
+
+    return events
+
+
+def finish(output, directory, trace=None):
+    """write report and trace of records in directory, then stop recording and remove records
+
+    :param output: filename of report, not written if None
+    :type output: str
+    :param directory: directory of records
+    :type directory: str
+    :param trace: filename of trace, not written if None
+    :type trace: str
+    """
+    try:
+        if output is not None:
+            write_report(output, directory)
+        if trace is not None:
+            write_trace(trace, directory)
+    finally:
+        disable()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""profile tasks of worker processes and threads by cProfile
+
+Every task submitted by :func:`ce_detector.metrics.submit` runs under its own
+``cProfile.Profile`` if the directory given by ``$CE_DETECTOR_PROFILE_DIR``
+is set, and dumps its stats into that directory. The variable is inherited
+by worker processes, so stats of all workers are merged by the main process
+into one pstats file with :func:`merge`.
+"""
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import shutil
+import threading
+
+# environment variable of directory of stats, inherited by worker processes
+PROFILE_DIR = "CE_DETECTOR_PROFILE_DIR"
+
+# number of hot functions in summary
+TOP = 25
+
+_tasks = itertools.count()
+
+
+def enable(directory):
+    """profile tasks of this process and its future worker processes
+
+    :param directory: directory of stats of tasks
+    :type directory: str
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.environ[PROFILE_DIR] = directory
+
+
+def disable():
+    """stop profiling tasks"""
+    os.environ.pop(PROFILE_DIR, None)
+
+
+def get_directory():
+    """directory of stats of tasks, None if profiling is disabled"""
+    return os.environ.get(PROFILE_DIR) or None
+
+
+def dump(profile, directory):
+    """dump stats of profile into a file named by process, thread and task"""
+    profile.dump_stats(
+        os.path.join(
+            directory, f"{os.getpid()}-{threading.get_ident()}-{next(_tasks)}.prof"
+        )
+    )
+
+
+def call(func, *args, **kwargs):
+    """call function under cProfile if profiling is enabled
+
+    :return: result of function
+    """
+    directory = get_directory()
+    if directory is None:
+        return func(*args, **kwargs)
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # another profiler is running in this thread
+        return func(*args, **kwargs)
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.disable()
+        dump(profile, directory)
+
+
+def merge(directory, output, top=TOP):
+    """merge stats of all tasks into one pstats file
+
+    :param directory: directory of stats of tasks
+    :type directory: str
+    :param output: filename of merged stats
+    :type output: str
+    :param top: number of hot functions in summary
+    :type top: int
+    :return: summary of hot functions sorted by internal time, empty if nothing is profiled
+    :rtype: str
+    """
+    files = sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".prof")
+    )
+    if not files:
+        return ""
+
+    summary = io.StringIO()
+    stats = pstats.Stats(*files, stream=summary)
+    stats.dump_stats(output)
+    # list the merged file instead of stats of every task in summary
+    stats.files = [output]
+    stats.strip_dirs().sort_stats("tottime").print_stats(top)
+
+    return summary.getvalue()
+
+
+def finish(output, directory, profile=None, top=TOP):
+    """merge stats of tasks, then stop profiling and remove stats of tasks
+
+    Merged stats are written to `ce_detector.prof` and the summary of hot
+    functions to `summary.txt` inside param:`output`.
+
+    :param output: directory of merged stats
+    :type output: str
+    :param directory: directory of stats of tasks
+    :type directory: str
+    :param profile: profile of main thread to add
+    :type profile: ``cProfile.Profile``
+    :param top: number of hot functions in summary
+    :type top: int
+    :return: summary of hot functions
+    :rtype: str
+    """
+    try:
+        if profile is not None:
+            profile.disable()
+            dump(profile, directory)
+
+        summary = merge(directory, os.path.join(output, "ce_detector.prof"), top)
+        with open(os.path.join(output, "summary.txt"), "w") as handle:
+            handle.write(summary)
+    finally:
+        disable()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return summary
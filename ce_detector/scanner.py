@@ -7,27 +7,61 @@ from typing import Iterable
 
 import numpy as np
 import pandas as pd
+import pysam as ps
 
+from . import metrics
+from .index import expand_ranges
+from .utils import FORMATS
+from .utils import measure
 from .utils import timethis
 
 
-def check(axis) -> np.array:
-    """check if cryptic exon has children
+def find_children(ce_genes, ce_starts, ce_ends, n_genes, n_starts, n_ends):
+    """find every junction read with N type nested in a cryptic exon of the same gene
+
+    Junction reads are sorted by gene and start once, then junction reads
+    starting inside every cryptic exon are located by binary search and only
+    those ending inside it are kept, which costs O((n+m) log n + hits).
+
+    :param ce_genes: gene ids of cryptic exons
+    :type ce_genes: numpy.array
+    :param ce_starts: starts of cryptic exons
+    :type ce_starts: numpy.array
+    :param ce_ends: ends of cryptic exons
+    :type ce_ends: numpy.array
+    :param n_genes: gene ids of junction reads with N type
+    :type n_genes: numpy.array
+    :param n_starts: starts of junction reads with N type
+    :type n_starts: numpy.array
+    :param n_ends: ends of junction reads with N type
+    :type n_ends: numpy.array
+    :return: (cryptic exon index, junction read index) of nested pairs
+    :rtype: tuple[numpy.array, numpy.array]
+    """
+    codes, _ = pd.factorize(np.concatenate([ce_genes, n_genes]))
+    codes = codes.astype(np.int64) << 32
+    ce_codes, n_codes = codes[: len(ce_genes)], codes[len(ce_genes) :]
 
-    Which means that check if the cryptic exon is split by others junction reads
-    in terms of start and end position
+    ce_starts, ce_ends = np.asarray(ce_starts, np.int64), np.asarray(ce_ends, np.int64)
+    n_starts, n_ends = np.asarray(n_starts, np.int64), np.asarray(n_ends, np.int64)
 
-    :param axis: an array, a junction read, included start and end
-    :type axis: numpy.array
-    :return: whether junction read can split cryptic exon
-    :rtype: bool
-    """
+    # junction reads sorted by packed key of gene and start
+    n_keys = n_codes | n_starts
+    order = np.argsort(n_keys, kind="stable")
+    n_keys = n_keys[order]
+
+    lo = np.searchsorted(n_keys, ce_codes | ce_starts, side="right")
+    hi = np.searchsorted(n_keys, ce_codes | ce_ends, side="left")
+    ce_idx, n_pos = expand_ranges(lo, hi)
+    n_idx = order[n_pos]
+
+    nested = n_ends[n_idx] < ce_ends[ce_idx]
 
-    return (axis[0] < 0) & (axis[1] > 0)
+    return ce_idx[nested], n_idx[nested]
 
 
-def assign_value(df_ce, ces, ns, ce_id, ns_id) -> None:
-    """assign value of `child column` for every cryptic exons that contains junction reads with N type
+def children_table(df_ce, df_n) -> pd.DataFrame:
+    """long-format table of junction reads with N type nested in cryptic exons
 
     Given the start and end of cryptic exons and junction reads,
     Note: types of junction reads contains N, D, A, DA, NDA. For details:
@@ -35,147 +69,280 @@ def assign_value(df_ce, ces, ns, ce_id, ns_id) -> None:
 
     :param df_ce: pandas.DataFrame of cryptic exons
     :type df_ce: pandas.DataFrame
-    :param ces: cryptic exons' pandas.DataFrame,
-        which has gene ids that both cryptic exon and junction
-        read own. It only contain gene id, start and end
-    :type ces: pandas.DataFrame
-    :param ns: pandas.DataFrame of junction reads whose type is N,
-        as well as has same gene id as cryptic exons
-    :type ns: pandas.DataFrame
-    :param ce_id: index of gene id of cryptic exons which has junction reads as children
-    :type ce_id: numpy.array
-    :param ns_id: index of gene id of junction reads with N type, which have junction reads as children
-    :type ns_id: numpy.array
+    :param df_n: pandas.DataFrame of junction reads with N type
+    :type df_n: pandas.DataFrame
+    :return: one row for every child with the position `ce` of its cryptic exon
+        in param:`df_ce`, columns of the cryptic exon and `child_start`, `child_end`
+    :rtype: pandas.DataFrame
     """
-    children_info = f"{ns.iloc[ns_id, 0]}-{ns.iloc[ns_id, 1]},"  # start-end
-    gene_id = ces.index[ce_id]
-    length = ces.iloc[ce_id, 1] - ces.iloc[ce_id, 0]
-    df_ce.loc[(gene_id, length), "children"] += children_info
+    ce_idx, n_idx = find_children(
+        df_ce["gene"].values,
+        df_ce["start"].values,
+        df_ce["end"].values,
+        df_n["gene"].values,
+        df_n["start"].values,
+        df_n["end"].values,
+    )
 
+    return (
+        df_ce.iloc[ce_idx]
+        .loc[:, ["chrom", "start", "end", "strand", "gene"]]
+        .assign(
+            ce=ce_idx,
+            child_start=df_n["start"].values[n_idx],
+            child_end=df_n["end"].values[n_idx],
+        )
+        .reset_index(drop=True)
+    )
 
-def split_ce(df_ce, df_n) -> Iterable:
+
+def split_ce(df_ce, df_n, long=False) -> Iterable:
     """Iterator: check whether detected cryptic exons are split by other junction reads
 
+    Children of every cryptic exon are gathered by a single groupby over
+    the table return from :func:`children_table`.
+
     :param df_ce: pandas.DataFrame of cryptic exons return from :func:`find_ce`
     :type df_ce: pandas.DataFrame
     :param df_n: pandas.DataFrame of junction reads with N type
     :type df_n: pandas.DataFrame
-    :return: param:`df_ce` with new column `children`
+    :param long: whether to return long-format table of children as well
+    :type long: bool
+    :return: param:`df_ce` with new column `children` (start-end,start-end,)
+        and long-format table of children if param:`long`
     :rtype: iterator
     """
-
-    # set gene as index
-    df_ce.set_index("gene", inplace=True)
-    df_n.set_index("gene", inplace=True)
-    # get genes contained in both cryptic exons and junction reads with N type
-    gene_ind = set(df_ce.index) & set(df_n.index)
-
-    ces = df_ce.loc[gene_ind, ["start", "end"]]
-    ns = df_n.loc[gene_ind, ["start", "end"]]
-    ces_values = ces.values
-    ns_values = ns.values
+    children = children_table(df_ce, df_n)
+
+    labels = (
+        children["child_start"].astype(str)
+        + "-"
+        + children["child_end"].astype(str)
+        + ","
+    )  # start-end
+    df_ce = df_ce.assign(
+        children=labels.groupby(children["ce"].values)
+        .agg("".join)
+        .reindex(range(len(df_ce)), fill_value="")
+        .values
+    )
     # set another index in case that one gene has more than one cryptic exons
-    df_ce.set_index("length", append=True, inplace=True)
-
-    if ces_values.size > 1:
-
-        x = np.apply_along_axis(
-            lambda row: row - ns_values,
-            1,
-            ces_values,
-        )  # iter for row
+    df_ce = df_ce.set_index(["gene", "length"])
 
-        bool_re = np.apply_along_axis(check, 2, x)
+    if long:
+        return df_ce, children.drop(columns="ce")
 
-        position = np.argwhere(
-            bool_re,
-        )  # return row id, n_df id[[ce_id,n_id],[ce_id,n_id]]
+    return df_ce
 
-        if position.size >= 1:
 
-            for ce_id, ns_id in position:
-                assign_value(df_ce, ces, ns, ce_id, ns_id)
+def join_keys(left_keys, right_keys):
+    """find every pair of equal integer keys like an inner merge
 
-    else:
+    Right keys are sorted once and matches of every left key are located by
+    binary search. Pairs are ordered by left row, then by right row, which
+    is the order of ``pandas.merge`` with ``how="inner"``.
 
-        x = ces_values - ns_values
-        bool_x = (x[:, 0] < 0) & (x[:, 1] > 0)
-        position = np.argwhere(bool_x)  # return [[n_id],[n_id]]
+    :param left_keys: keys of left rows
+    :type left_keys: numpy.array
+    :param right_keys: keys of right rows
+    :type right_keys: numpy.array
+    :return: (left index, right index) of matched pairs
+    :rtype: tuple[numpy.array, numpy.array]
+    """
+    order = np.argsort(right_keys, kind="stable")
+    right_keys = right_keys[order]
 
-        if position.size >= 1:
-            for ns_id in position.flatten():
-                assign_value(df_ce, ces, ns, ce_id=0, ns_id=ns_id)
+    lo = np.searchsorted(right_keys, left_keys, side="left")
+    hi = np.searchsorted(right_keys, left_keys, side="right")
+    left_idx, right_pos = expand_ranges(lo, hi)
 
-    return df_ce
+    return left_idx, order[right_pos]
 
 
-def find_ce(groups) -> Iterable:
+def find_ce(df, long=False, chrom=None) -> Iterable:
     """parse _result getting from annotations in order to detect cryptic exons
 
-    :param groups:  annotated junction reads are grouped by `strand` and `type`
-    :type groups: Groupby object return from ``Dataframe.groupby``
-    :return: pd.DataFrame of two strands
+    Junction reads with DA type are joined with D type on start and with A
+    type on end of the same gene. Chromosome and gene are encoded as integer
+    codes and packed with positions into one key, so that both joins are
+    answered by :func:`join_keys`. Strands missing any type give no
+    cryptic exons instead of failing.
+
+    :param df: annotated junction reads return from
+        :meth:`ce_detector.detector.JunctionMap.table`
+    :type df: pandas.DataFrame
+    :param long: whether to return long-format table of children as well
+    :type long: bool
+    :param chrom: chromosome of param:`df` recorded in metrics
+    :type chrom: str
+    :return: pd.DataFrame of two strands, and pd.DataFrame of their children if param:`long`
     :rtype: Iterable
     """
-    # old column  and new column
-    pick_col = (
-        "chrom",
-        "end_D",
-        "start_A",
-        "start",
-        "end",
-        "strand",
-        "score_DA",
-        "score_D",
-        "score",
-        "gene",
-    )
-    rename_col = (
-        "chrom",
-        "start",
-        "end",
-        "start_DA",
-        "end_DA",
-        "strand",
-        "score_DA",
-        "score_D",
-        "score_A",
-        "gene",
-    )
+    codes = df.groupby(["chrom", "gene"], sort=False).ngroup().values << 32
+    starts = codes | df["start"].values.astype(np.int64)
+    ends = codes | df["end"].values.astype(np.int64)
 
-    result = []
+    result, children = [], []
 
     for strand in ("+", "-"):
+        on_strand = (df["strand"] == strand).values
+        da, d, a, n = (
+            np.flatnonzero(on_strand & (df["type"] == reads_type).values)
+            for reads_type in ("DA", "D", "A", "N")
+        )
+
+        da_idx, d_idx = join_keys(starts[da], starts[d])
+        da, d = da[da_idx], d[d_idx]
+        pairs, a_idx = join_keys(ends[da], ends[a])
+        da, d, a = da[pairs], d[pairs], a[a_idx]
+
+        valid = df["end"].values[d] < df["start"].values[a]
+        da, d, a = da[valid], d[valid], a[valid]
+
+        temp = pd.DataFrame(
+            dict(
+                chrom=df["chrom"].values[da],
+                start=df["end"].values[d],
+                end=df["start"].values[a],
+                start_DA=df["start"].values[da],
+                end_DA=df["end"].values[da],
+                strand=df["strand"].values[a],
+                score_DA=df["score"].values[da],
+                score_D=df["score"].values[d],
+                score_A=df["score"].values[a],
+                qvalue_DA=df["qvalue"].values[da],
+                qvalue_D=df["qvalue"].values[d],
+                qvalue_A=df["qvalue"].values[a],
+                gene=df["gene"].values[da],
+            )
+        ).assign(length=lambda df: df.end - df.start)
+
+        with measure("split_ce", chrom=chrom):
+            strand_result, strand_children = split_ce(temp, df.iloc[n], long=True)
+            metrics.add_counts(candidates=len(temp), children=len(strand_children))
+        result.append(strand_result)
+        children.append(strand_children)
+
+    if long:
+        return pd.concat(result).reset_index(), pd.concat(children, ignore_index=True)
+
+    return pd.concat(result).reset_index()
+
+
+# leading columns of cryptic exons written in BED format
+BED_COLUMNS = ("chrom", "start", "end", "gene", "score_DA", "strand")
+
+# leading columns of children of cryptic exons written in BED format
+CHILDREN_BED_COLUMNS = ("chrom", "child_start", "child_end", "gene")
+
+
+def check_format(fmt):
+    """check format of output and whether its optional dependency is installed
+
+    :param fmt: format of output
+    :type fmt: str
+    :raises ValueError: if format is unknown
+    :raises ImportError: if pyarrow is missing for parquet or arrow
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt!r}, expected one of {FORMATS}")
+
+    if fmt in ("parquet", "arrow"):
         try:
-            da = groups.get_group((strand, "DA"))
-            d = groups.get_group((strand, "D"))
-            a = groups.get_group((strand, "A"))
-            n = groups.get_group((strand, "N"))
-        except KeyError as exc:
-            raise exc
+            import pyarrow  # noqa: F401
+        except ImportError as exc:
+            raise ImportError(
+                f"pyarrow is required to write {fmt} output, "
+                "install it by `pip install ce_detector[arrow]`"
+            ) from exc
+
+
+def write_result(result, output, fmt="tsv", bed_columns=BED_COLUMNS):
+    """write cryptic exons or their children in one of :data:`FORMATS`
+
+    Parquet and Arrow files are written by ``pyarrow``. BED file is sorted by
+    position, compressed by bgzip and indexed by tabix, so cryptic exons of a
+    region are queried with ``tabix`` or ``pysam.TabixFile``. Positions of
+    cryptic exons are 0-based and half-open as required by BED.
+
+    :param result: cryptic exons or children return from :func:`find_ce`
+    :type result: pandas.DataFrame
+    :param output: filename of output, `.gz` is appended to BED file if absent
+    :type output: str
+    :param fmt: format of output
+    :type fmt: str
+    :param bed_columns: leading columns of BED file, starting with chromosome,
+        start and end. Defaults to :data:`BED_COLUMNS`
+    :type bed_columns: tuple
+    :return: filename of output
+    :rtype: str
+    """
+    check_format(fmt)
+
+    with measure("Write"):
+        metrics.add_counts(rows=len(result))
+
+        if fmt == "tsv":
+            result.to_csv(output, sep="\t", encoding="utf8", index=False)
+        elif fmt == "parquet":
+            result.to_parquet(output, index=False)
+        elif fmt == "arrow":
+            result.reset_index(drop=True).to_feather(output)
         else:
-            temp = (
-                da.merge(
-                    d,
-                    left_on=["chrom", "start", "gene"],
-                    right_on=["chrom", "start", "gene"],
-                    suffixes=("_DA", "_D"),
-                )
-                .merge(
-                    a,
-                    left_on=["chrom", "end_DA", "gene"],
-                    right_on=["chrom", "end", "gene"],
-                    suffixes=("", "_A"),
-                )[lambda df: df["end_D"] < df["start_A"]]
-                .pipe(lambda df: df.loc[:, pick_col])
-                .rename(columns=dict(zip(pick_col, rename_col)))
-                .assign(length=lambda df: df.end - df.start)
-                .assign(children="")
+            if output.endswith(".gz"):
+                output = output[:-3]
+
+            chrom, start, end = bed_columns[:3]
+            columns = [
+                *bed_columns,
+                *result.columns.difference(bed_columns, sort=False),
+            ]
+            result = (
+                result.loc[:, columns]
+                .assign(_chrom=lambda df: pd.factorize(df[chrom])[0])
+                .sort_values(["_chrom", start, end], kind="stable")
+                .drop(columns="_chrom")
+                .rename(columns={chrom: f"#{chrom}"})
             )
+            result.to_csv(output, sep="\t", encoding="utf8", index=False)
 
-            result.append(split_ce(temp, n))
+            # compress into output.gz and remove the plain file
+            output = ps.tabix_index(output, preset="bed", force=True)
+
+    return output
 
-    return pd.concat(result).reset_index()
+
+def children_output(output, fmt):
+    """filename of children of cryptic exons written next to param:`output`
+
+    :param output: filename of cryptic exons
+    :type output: str
+    :param fmt: format of output
+    :type fmt: str
+    :return: `{output}.children.{fmt}` with extension of param:`output` removed
+    :rtype: str
+    """
+    if output.endswith(f".{fmt}"):
+        output = output[: -len(fmt) - 1]
+
+    return f"{output}.children.{fmt}"
+
+
+def write_children(children, output, fmt="tsv"):
+    """write long-format table of children of cryptic exons next to them
+
+    :param children: children return from :func:`find_ce` with param:`long`
+    :type children: pandas.DataFrame
+    :param output: filename of cryptic exons, see :func:`children_output`
+    :type output: str
+    :param fmt: format of output
+    :type fmt: str
+    :return: filename of output
+    :rtype: str
+    """
+    return write_result(
+        children, children_output(output, fmt), fmt, CHILDREN_BED_COLUMNS
+    )
 
 
 class Scanner:
@@ -198,7 +365,7 @@ class Scanner:
 
     @timethis(name="File Writer for Scanner", message="FINISHED")
     def write2file(self, logger, verbose=False):
-        """ start iterator and write _result to file"""
+        """start iterator and write _result to file"""
         if verbose:
             logger.info("Beginning Writing")
         pd.concat(self._result).to_csv(self.output, sep="\t", encoding="utf8")
@@ -219,30 +386,14 @@ class Scanner:
         if verbose:
             logger.info(f"Chrom {junctionmap.chrom} Scanner Beginning ")
 
-        groups = pd.DataFrame(
-            [
-                [read.chrom, read.start, read.end, read.strand, read.score, *info]
-                for read in junctionmap
-                for info in read.information
-                if read.score >= self.cutoff
-            ],
-            columns=[
-                "chrom",
-                "start",
-                "end",
-                "strand",
-                "score",
-                "type",
-                "dk",
-                "ak",
-                "gene",
-            ],
-        ).pipe(lambda df: df.groupby(["strand", "type"]))
-
-        try:
-            junctionmap.result = find_ce(groups)
-        except KeyError as exc:
-            logger.warn(f"Chrom {junctionmap.chrom} KeyError {exc.args[0]}")
+        table = junctionmap.table(self.cutoff)
+        with measure("find_ce", chrom=junctionmap.chrom):
+            junctionmap.result, junctionmap.children = find_ce(
+                table, long=True, chrom=junctionmap.chrom
+            )
+            metrics.add_counts(
+                annotations=len(table), cryptic_exons=len(junctionmap.result)
+            )
 
         if verbose:
             logger.info(f"Chrom {junctionmap.chrom} Scanner Finished")
@@ -3,30 +3,42 @@
 import logging
 import time
 from concurrent import futures
+from contextlib import contextmanager
+from functools import lru_cache
 from functools import partial
 from functools import wraps
 from os.path import dirname
 from os.path import join
 
-import importlib_resources
-import yaml
-from rich.logging import RichHandler
+from . import metrics
+
+# formats of output of cryptic exons, see :func:`ce_detector.scanner.write_result`
+FORMATS = ("tsv", "parquet", "arrow", "bed.gz")
 
 
 class Timer:
-    """construct  Timer to show working time of tasks"""
+    """construct  Timer to show working time of tasks
+
+    Besides wall time, CPU time of the running thread is measured and the
+    wall-clock time of the first start is kept for metrics and traces.
+    """
 
-    def __init__(self, func=time.perf_counter):
+    def __init__(self, func=time.perf_counter, cpu_func=time.thread_time):
         """init values
 
         Args:
             func : Defaults to time.perf_counter.
+            cpu_func : Defaults to time.thread_time.
         """
         self.elapsed = 0.0
+        self.cpu_elapsed = 0.0
+        self.started = None
 
         self._func = func
+        self._cpu_func = cpu_func
 
         self._start = None
+        self._cpu_start = None
 
     def start(self):
         """start a task
@@ -38,7 +50,11 @@ class Timer:
         if self._start is not None:
             raise RuntimeError("Already started")
 
+        if self.started is None:
+            self.started = time.time()
+
         self._start = self._func()
+        self._cpu_start = self._cpu_func()
 
     def stop(self):
         """end a task
@@ -52,12 +68,15 @@ class Timer:
         end = self._func()
 
         self.elapsed += end - self._start
+        self.cpu_elapsed += self._cpu_func() - self._cpu_start
 
         self._start = None
 
     def reset(self):
         """reset the working time"""
         self.elapsed = 0
+        self.cpu_elapsed = 0
+        self.started = None
 
     def running(self):
         """check if task is running
@@ -92,6 +111,8 @@ def rich_logger(logger_name, create_file=False, level=logging.INFO):
     :return: logger
     :rtype: instance
     """
+    from rich.logging import RichHandler
+
     # create logger for prd_ci
     log = logging.getLogger(logger_name)
 
@@ -167,16 +188,44 @@ def get_logger(logger_name, create_file=False, level=logging.INFO):
     return log
 
 
+@lru_cache(maxsize=None)
 def get_yaml():
     """get information of chromosome stored in yaml file
+
+    The file is loaded once on first use and cached, so importing modules
+    never reads it. The result is shared and should not be modified.
+
     :return: chromosome values
     :rtype: dict
     """
+    import yaml
+
     if __package__:
+        import importlib_resources
+
         path = join(importlib_resources.files(__package__).as_posix(), "chromosome.yml")
     else:
         path = join(dirname(__file__), "chromosome.yml")
-    return yaml.safe_load(open(path))
+
+    with open(path) as handle:
+        return yaml.safe_load(handle)
+
+
+def get_alias(path=None):
+    """get alias table mapping chromosomes in bam file to chromosomes in annotation file
+
+    :param path: yaml file of alias table. Defaults to `chr2hg38` of chromosome.yml
+    :type path: str
+    :return: chromosome in bam mapping to chromosome in annotation
+    :rtype: dict
+    """
+    import yaml
+
+    if path is None:
+        return dict(get_yaml()["chr2hg38"])
+
+    with open(path) as handle:
+        return yaml.safe_load(handle) or {}
 
 
 def timethis(
@@ -197,25 +246,69 @@ def timethis(
         )
 
     logname = name if name else func.__module__
-    log = (
-        rich_logger(logname, create_file=creat_file)
-        if rich
-        else get_logger(logname, create_file=creat_file)
-    )
     logmsg = message if message else func.__name__
 
+    # logger is built on first call rather than at decoration
+    @lru_cache(maxsize=None)
+    def get_log():
+        return (
+            rich_logger(logname, create_file=creat_file)
+            if rich
+            else get_logger(logname, create_file=creat_file)
+        )
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        with Timer() as t:
+        log = get_log()
+        with measure(logname, chrom=find_chrom(args, kwargs)) as timer:
             temp = func(*args, logger=log, **kwargs)
 
-        _ = f"{t} {logmsg}"
+        log.debug(f"{logmsg} {timer.elapsed:.2f}s")
 
         return temp
 
     return wrapper
 
 
+def find_chrom(args, kwargs):
+    """chromosome processed by a stage from its arguments
+
+    :return: value of argument `chrom`, or attribute `chrom` of the first
+        argument such as junction map, None if absent
+    :rtype: str
+    """
+    if "chrom" in kwargs:
+        return kwargs["chrom"]
+
+    for value in (*kwargs.values(), *args):
+        chrom = getattr(value, "chrom", None)
+        if isinstance(chrom, str):
+            return chrom
+
+    return None
+
+
+@contextmanager
+def measure(stage, chrom=None):
+    """measure a stage by :class:`Timer` and record it in metrics registry
+
+    Numbers of processed items are added by :func:`ce_detector.metrics.add_counts`
+    inside the stage.
+
+    :param stage: name of stage
+    :type stage: str
+    :param chrom: chromosome processed by stage
+    :type chrom: str
+    """
+    rss = metrics.current_rss() if metrics.get_directory() else None
+
+    with metrics.counting() as counts:
+        with Timer() as timer:
+            yield timer
+
+        metrics.record(stage, timer, chrom=chrom, counts=counts, rss=rss)
+
+
 def get_worker(handler):
     worker = (
         futures.ProcessPoolExecutor()
@@ -223,3 +316,22 @@ def get_worker(handler):
         else futures.ThreadPoolExecutor(max_workers=24)
     )
     return worker
+
+
+def get_windows(length, window_size):
+    """split a chromosome into fixed-size windows
+
+    :param length: length of chromosome
+    :type length: int
+    :param window_size: size of window, the whole chromosome is one window if not positive
+    :type window_size: int
+    :return: 0-based (start, end) of every window
+    :rtype: list
+    """
+    if window_size <= 0:
+        return [(0, length)]
+
+    return [
+        (start, min(start + window_size, length))
+        for start in range(0, max(length, 1), window_size)
+    ]
@@ -45,6 +45,7 @@ except FileNotFoundError:
 # What packages are optional?
 EXTRAS = {
     # 'fancy feature': ['django'],
+    "arrow": ["pyarrow"],
 }
 
 # The rest you shouldn't have to touch too much :)
@@ -119,7 +120,9 @@ setup(
     author_email=EMAIL,
     python_requires=REQUIRES_PYTHON,
     url=URL,
-    packages=find_packages(exclude=["tests", "*.tests", "*.tests.*", "tests.*"]),
+    packages=find_packages(
+        exclude=["tests", "*.tests", "*.tests.*", "tests.*", "benchmarks", "benchmarks.*"]
+    ),
     # If your package is a single module, use this instead of 'packages':
     # py_modules=['mypackage'],
     entry_points={
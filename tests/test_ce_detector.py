@@ -21,3 +21,990 @@ def test_content(response):
     """Sample pytest test function with the pytest fixture as an argument."""
     # from bs4 import BeautifulSoup
     # assert 'GitHub' in BeautifulSoup(response.content).title.string
+
+
+class FakeRead:
+    """Minimal stand-in for ``pysam.AlignedSegment``."""
+
+    def __init__(self, reference_start, cigartuples, mapping_quality=60):
+        self.reference_start = reference_start
+        self.cigartuples = cigartuples
+        self.mapping_quality = mapping_quality
+        self.is_unmapped = False
+
+    def get_cigar_stats(self):
+        blocks = [0] * 11
+        for operation, _ in self.cigartuples:
+            blocks[operation] += 1
+        return None, blocks
+
+
+def test_count_junctions():
+    from ce_detector.detector import JunctionDetector
+
+    reads = [
+        FakeRead(100, [(0, 50), (3, 1000), (0, 50)]),
+        FakeRead(120, [(4, 5), (0, 30), (3, 1000), (0, 20), (3, 300), (0, 10)]),
+        FakeRead(100, [(0, 50), (3, 1000), (0, 50)], mapping_quality=10),
+        FakeRead(0, [(0, 100)]),
+    ]
+    junctions, blocks = JunctionDetector.count_junctions(iter(reads), quality=30)
+
+    assert junctions == {(150, 1150): 2, (1170, 1470): 1}
+    assert blocks[150, 1150][1:] == (50, 1000, 50)
+    assert blocks[1170, 1470][1:] == (20, 300, 10)
+
+
+def test_splice_blocks():
+    from ce_detector.detector import JunctionDetector
+
+    cigartuples = [
+        (4, 5),
+        (0, 30),
+        (1, 2),
+        (0, 10),
+        (3, 1000),
+        (0, 20),
+        (2, 3),
+        (0, 5),
+        (3, 300),
+        (0, 10),
+        (4, 7),
+    ]
+
+    assert JunctionDetector.splice_blocks(100, cigartuples) == [
+        (140, 1140, 40, 1000, 25),
+        (1168, 1468, 25, 300, 10),
+    ]
+    assert JunctionDetector.splice_blocks(100, [(0, 100)]) == []
+
+
+def test_get_pvalue():
+    from ce_detector.detector import JunctionDetector
+
+    p_values = JunctionDetector.get_pvalue(
+        [(50, 1000, 50), (10, 1000, 40), (0, 1000, 0)]
+    )
+    expected = [1 - (1 - (1 / 4) ** R) ** (1000 - R + 1) for R in (50, 10)]
+
+    assert p_values[:2] == pytest.approx(expected)
+    assert p_values[2] == 1
+
+
+def test_get_windows():
+    from ce_detector.utils import get_windows
+
+    assert get_windows(25, 10) == [(0, 10), (10, 20), (20, 25)]
+    assert get_windows(25, 0) == [(0, 25)]
+
+
+def test_merge_junctions():
+    from collections import Counter
+
+    from ce_detector.detector import JunctionDetector
+
+    left = (Counter({(10, 50): 2}), {(10, 50): (0.5, 10, 40, 20)})
+    right = (
+        Counter({(10, 50): 1, (60, 90): 1}),
+        {(10, 50): (0.5, 20, 40, 40), (60, 90): (1.0, 5, 30, 5)},
+    )
+    junctions, blocks = JunctionDetector.merge_junctions([left, right])
+
+    assert junctions == {(10, 50): 3, (60, 90): 1}
+    assert blocks[10, 50] == (0.5, 10, 40, 20)
+
+
+def test_junctionmap_columns():
+    import pickle
+
+    from ce_detector.detector import JunctionMap
+    from ce_detector.detector import encode_motif
+
+    jmap = JunctionMap("chr1")
+    jmap.append(
+        start=[10, 60, 100],
+        end=[50, 90, 200],
+        idn=[1, 2, 3],
+        score=[3, 1, 5],
+        strand=[0, 1, 2],
+        anchor=[encode_motif("GT"), encode_motif("CT"), encode_motif("AA")],
+        acceptor=[encode_motif("AG"), encode_motif("AC"), encode_motif("TT")],
+        pvalue=[0.01, 0.5, 0.001],
+    )
+    jmap.add_annotation([2, 0], [4, 0], [1, 0], [0, 0], ["g2", "g1"])
+
+    read = jmap[0]
+    assert (read.start, read.end, read.strand, read.anchor, read.acceptor) == (
+        10,
+        50,
+        "+",
+        "GT",
+        "AG",
+    )
+    assert read.information == [["DA", 0, 0, "g1"]]
+    assert str(read) == "chr1\t10\t50\t1\t3\t+\tGT-AG"
+
+    filtered = pickle.loads(pickle.dumps(jmap.filter([False, True, True])))
+    assert [r.idn for r in filtered] == [2, 3]
+    assert filtered[0].information == []
+    assert filtered[1].information == [["N", 1, 0, "g2"]]
+    assert jmap[2] in filtered and jmap[0] not in filtered
+
+    table = jmap.table(cutoff=3)
+    assert table.drop(columns="qvalue").values.tolist() == [
+        ["chr1", 10, 50, "+", 3, "DA", 0, 0, "g1"],
+        ["chr1", 100, 200, "N", 5, "N", 1, 0, "g2"],
+    ]
+    # q-values are missing until FDR is corrected
+    assert table["qvalue"].isna().all()
+    assert list(table["type"].cat.categories) == list(JunctionMap.TYPES)
+
+
+def test_benjamini_hochberg():
+    import numpy as np
+
+    from ce_detector.detector import JunctionDetector
+    from ce_detector.detector import JunctionMap
+
+    pvalues = [np.array([0.01, 0.04, 0.03]), np.array([]), np.array([0.005, 0.5])]
+    masks, qvalues = JunctionDetector.benjamini_hochberg(pvalues)
+
+    assert [mask.tolist() for mask in masks] == [[True, True, True], [], [True, False]]
+    assert np.allclose(np.concatenate(qvalues), [0.025, 0.05, 0.05, 0.025, 0.5])
+
+    try:
+        from statsmodels.stats.multitest import fdrcorrection
+    except ImportError:
+        pass
+    else:
+        flat = np.random.default_rng(0).uniform(0, 0.1, 1000) ** 2
+        masks, qvalues = JunctionDetector.benjamini_hochberg([flat[:300], flat[300:]])
+        reject, corrected = fdrcorrection(flat)
+        assert np.array_equal(np.concatenate(masks), reject)
+        assert np.allclose(np.concatenate(qvalues), corrected)
+
+    jmap = JunctionMap("chr1")
+    jmap.append(
+        start=[10, 60],
+        end=[50, 90],
+        idn=[1, 2],
+        score=[3, 1],
+        strand=[0, 0],
+        anchor=[0, 0],
+        acceptor=[0, 0],
+        pvalue=[0.01, 0.5],
+    )
+    (filtered,) = JunctionDetector.fdr_correction({"chr1": jmap}).values()
+    assert [(read.idn, read.qvalue) for read in filtered] == [(1, 0.02)]
+
+
+def test_check_strands():
+    from ce_detector.detector import JunctionDetector
+    from ce_detector.detector import encode_motif
+
+    pairs = [("GT", "AG"), ("CT", "AC"), ("GT", "AT"), ("AA", "TT"), ("GC", "AG")]
+    strands = JunctionDetector.check_strands(
+        [encode_motif(anchor) for anchor, _ in pairs],
+        [encode_motif(acceptor) for _, acceptor in pairs],
+    )
+
+    assert strands.tolist() == [0, 1, 1, 2, 0]
+    assert [JunctionDetector.check_strand(*pair) for pair in pairs] == [
+        "+",
+        "-",
+        "-",
+        "N",
+        "+",
+    ]
+
+
+GFF = """\
+chr1\tsim\tgene\t100\t900\t.\t+\t.\tID=g1
+chr1\tsim\tmRNA\t100\t900\t.\t+\t.\tID=t1;Parent=g1
+chr1\tsim\texon\t100\t200\t.\t+\t.\tID=e1;Parent=t1
+chr1\tsim\texon\t400\t500\t.\t+\t.\tID=e2;Parent=t1
+chr1\tsim\texon\t800\t900\t.\t+\t.\tID=e3;Parent=t1
+chr1\tsim\tmRNA\t100\t900\t.\t+\t.\tID=t2;Parent=g1
+chr1\tsim\texon\t100\t200\t.\t+\t.\tID=e4;Parent=t2
+chr1\tsim\texon\t800\t900\t.\t+\t.\tID=e5;Parent=t2
+chr1\tsim\tgene\t1000\t1200\t.\t-\t.\tID=g2
+chr1\tsim\tmRNA\t1000\t1200\t.\t-\t.\tID=t3;Parent=g2
+chr1\tsim\texon\t1000\t1200\t.\t-\t.\tID=e6;Parent=t3
+chr2\tsim\tgene\t50\t300\t.\t+\t.\tID=g3
+chr2\tsim\tmRNA\t50\t300\t.\t+\t.\tID=t4;Parent=g3
+chr2\tsim\texon\t50\t100\t.\t+\t.\tID=e7;Parent=t4
+chr2\tsim\texon\t200\t300\t.\t+\t.\tID=e8;Parent=t4
+"""
+
+
+@pytest.fixture
+def gffdb(tmp_path):
+    gffutils = pytest.importorskip("gffutils")
+    path = tmp_path / "annotation.db"
+    gffutils.create_db(
+        GFF,
+        str(path),
+        from_string=True,
+        merge_strategy="create_unique",
+        keep_order=True,
+    )
+    return str(path)
+
+
+def test_annotation_index(gffdb, tmp_path):
+    from ce_detector.index import AnnotationIndex
+
+    AnnotationIndex.from_db(gffdb).save(tmp_path / "annotation.idx")
+    index = AnnotationIndex.load(tmp_path / "annotation.idx")
+
+    # g2 has only one exon
+    assert index.gene_ids.tolist() == ["g1", "g3"]
+    assert index.introns(index.genes("chr1").start).tolist() == [
+        [201, 399],
+        [201, 799],
+        [501, 799],
+    ]
+    assert index.introns(index.genes("chr2").start).tolist() == [[101, 199]]
+    assert index.genes("chr3") == slice(0, 0)
+
+
+def test_overlap_pairs():
+    import numpy as np
+
+    from ce_detector.index import overlap_pairs
+
+    rng = np.random.default_rng(0)
+    gene_starts = np.sort(rng.integers(0, 10_000, 200))
+    gene_ends = gene_starts + rng.integers(0, 3_000, 200)
+    starts = rng.integers(0, 12_000, 500)
+    ends = starts + rng.integers(1, 2_000, 500)
+
+    junction_idx, gene_idx = overlap_pairs(starts, ends, gene_starts, gene_ends)
+    expected = np.argwhere(
+        (gene_starts[None, :] <= ends[:, None])
+        & (gene_ends[None, :] >= starts[:, None])
+    )
+
+    assert sorted(zip(junction_idx, gene_idx)) == sorted(map(tuple, expected))
+    assert (np.diff(junction_idx) >= 0).all()
+
+
+def test_classify_junctions():
+    import numpy as np
+
+    from ce_detector.annotator import Annotator
+    from ce_detector.detector import JunctionMap
+
+    junction_list = np.array([[101, 199], [101, 399], [201, 399], [501, 799]])
+    starts = np.array([100, 100, 100, 300, 200, 0])
+    ends = np.array([199, 799, 250, 399, 399, 50])
+
+    reads_types, donors_skipped, acceptors_skipped = Annotator.classify_junctions(
+        starts, ends, junction_list
+    )
+
+    assert [JunctionMap.TYPES[code] for code in reads_types] == [
+        "DA",
+        "NDA",
+        "D",
+        "A",
+        "DA",
+        "N",
+    ]
+    assert donors_skipped.tolist() == [0, 2, 1, 0, 0, 0]
+    assert acceptors_skipped.tolist() == [0, 3, 1, 0, 0, 0]
+    assert Annotator.detect_property(100, 799, junction_list) == ("NDA", 2, 3)
+
+
+def test_intron_cache(tmp_path):
+    from concurrent import futures
+
+    import numpy as np
+
+    from ce_detector.cache import IntronCache
+
+    cache = IntronCache(str(tmp_path), max_size=64)
+    introns = np.array([[101, 199], [201, 399]])
+
+    cache.put("db1", {"g1": introns, "g2": np.empty((0, 2))})
+    assert cache.get("db1", ["g1", "g2", "g3"])["g1"].tolist() == introns.tolist()
+    assert len(cache.get("db1", ["g2"])["g2"]) == 0
+    assert cache.get("db2", ["g1"]) == {}
+
+    # g1 is the least recently used entry
+    cache.put("db1", {"g3": introns})
+    cache.get("db1", ["g3"])
+    cache.put("db1", {"g4": introns})
+    assert set(cache.get("db1", ["g1", "g2", "g3", "g4"])) == {"g2", "g3", "g4"}
+    assert cache.size() <= 64
+
+    # one cache is shared by threads of annotation tasks
+    cache = IntronCache(str(tmp_path / "shared"))
+    with futures.ThreadPoolExecutor(8) as executor:
+        tasks = [
+            executor.submit(
+                lambda ind: [
+                    cache.put("db1", {f"g{ind}-{step}": introns})
+                    or cache.get("db1", [f"g{ind}-{step}"])
+                    for step in range(20)
+                ],
+                ind,
+            )
+            for ind in range(8)
+        ]
+        for task in tasks:
+            assert all(len(result) == 1 for result in task.result())
+    assert len(cache.get("db1", [f"g{ind}-19" for ind in range(8)])) == 8
+
+
+def test_find_children():
+    import numpy as np
+
+    from ce_detector.scanner import find_children
+
+    rng = np.random.default_rng(1)
+    ce_genes = rng.choice(["g1", "g2", "g3"], 50)
+    ce_starts = rng.integers(0, 5_000, 50)
+    ce_ends = ce_starts + rng.integers(1, 1_000, 50)
+    n_genes = rng.choice(["g1", "g2", "g4"], 300)
+    n_starts = rng.integers(0, 6_000, 300)
+    n_ends = n_starts + rng.integers(1, 300, 300)
+
+    ce_idx, n_idx = find_children(
+        ce_genes, ce_starts, ce_ends, n_genes, n_starts, n_ends
+    )
+    expected = np.argwhere(
+        (ce_genes[:, None] == n_genes[None, :])
+        & (n_starts[None, :] > ce_starts[:, None])
+        & (n_ends[None, :] < ce_ends[:, None])
+    )
+
+    assert sorted(zip(ce_idx, n_idx)) == sorted(map(tuple, expected))
+
+
+def test_split_ce():
+    import pandas as pd
+
+    from ce_detector.scanner import split_ce
+
+    df_ce = pd.DataFrame(
+        dict(
+            chrom="1",
+            start=[100, 500, 900],
+            end=[200, 600, 1000],
+            strand="+",
+            gene=["g1", "g1", "g2"],
+            length=100,
+        )
+    )
+    df_n = pd.DataFrame(
+        dict(start=[110, 150, 510, 950, 120], end=[120, 190, 700, 960, 130])
+    ).assign(gene=["g1", "g1", "g1", "g1", "g2"])
+
+    result, children = split_ce(df_ce, df_n, long=True)
+
+    assert result["children"].tolist() == ["110-120,150-190,", "", ""]
+    assert result.index.tolist() == [("g1", 100), ("g1", 100), ("g2", 100)]
+    assert children[["start", "child_start", "child_end"]].values.tolist() == [
+        [100, 110, 120],
+        [100, 150, 190],
+    ]
+
+
+def test_find_ce():
+    import numpy as np
+    import pandas as pd
+
+    from ce_detector.scanner import find_ce
+    from ce_detector.scanner import join_keys
+
+    left, right = join_keys(np.array([5, 3, 5, 9]), np.array([5, 1, 3, 5, 5]))
+    assert list(zip(left, right)) == [
+        (0, 0),
+        (0, 3),
+        (0, 4),
+        (1, 2),
+        (2, 0),
+        (2, 3),
+        (2, 4),
+    ]
+
+    rows = [
+        # type, start, end, score, gene
+        ("DA", 100, 900, 20, "g1"),
+        ("D", 100, 300, 5, "g1"),
+        ("A", 500, 900, 6, "g1"),
+        ("N", 320, 480, 2, "g1"),
+        ("D", 100, 300, 4, "g2"),
+        ("DA", 100, 900, 10, "g2"),
+    ]
+    df = pd.DataFrame(rows, columns=["type", "start", "end", "score", "gene"]).assign(
+        chrom="chr1", strand="+", dk=0, ak=0, qvalue=lambda df: df["score"] / 100
+    )
+
+    # no junction read on minus strand and no A type in g2
+    result, children = find_ce(df, long=True)
+    assert result[["gene", "start", "end", "score_DA", "children"]].values.tolist() == [
+        ["g1", 300, 500, 20, "320-480,"]
+    ]
+    assert result[["qvalue_DA", "qvalue_D", "qvalue_A"]].values.tolist() == [
+        [0.2, 0.05, 0.06]
+    ]
+    assert children[["child_start", "child_end"]].values.tolist() == [[320, 480]]
+
+    result, children = find_ce(df[df["type"] != "A"], long=True)
+    assert result.empty and children.empty
+
+
+def test_get_contigs(tmp_path):
+    import pysam
+
+    from ce_detector.main import get_contigs
+
+    bam = str(tmp_path / "reads.bam")
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [
+            {"SN": "chr1", "LN": 1000},
+            {"SN": "chr2", "LN": 1000},
+            {"SN": "chrUn", "LN": 1000},
+            {"SN": "chr3", "LN": 1000},
+        ],
+    }
+    with pysam.AlignmentFile(bam, "wb", header=header) as handle:
+        for tid, n_reads in ((0, 1), (2, 4), (3, 2)):
+            for ind in range(n_reads):
+                read = pysam.AlignedSegment(handle.header)
+                read.query_name = f"r{tid}_{ind}"
+                read.reference_id, read.reference_start = tid, 10 * ind
+                read.cigarstring, read.query_sequence = "4M", "ACGT"
+                handle.write(read)
+    pysam.index(bam)
+
+    contigs = get_contigs(
+        bam, {"NC_1", "NC_2", "chr3"}, {"chr1": "NC_1", "chr2": "NC_2"}
+    )
+    # chr2 has no mapped reads and chrUn is absent in annotation
+    assert contigs == {"chr1": ("NC_1", 1), "chr3": ("chr3", 2)}
+
+
+def test_write_result(tmp_path):
+    import pandas as pd
+    import pysam
+
+    from ce_detector.scanner import write_result
+
+    result = pd.DataFrame(
+        dict(
+            gene=["g2", "g1", "g3"],
+            length=[50, 100, 10],
+            chrom=["chr1", "chr1", "chr2"],
+            start=[500, 100, 10],
+            end=[550, 200, 20],
+            strand=["-", "+", "+"],
+            score_DA=[3, 5, 7],
+            children=["", "120-130,", ""],
+        )
+    )
+
+    output = write_result(result, str(tmp_path / "ce.bed"), "bed.gz")
+    assert output == str(tmp_path / "ce.bed.gz")
+
+    with pysam.TabixFile(output) as tabix:
+        assert tabix.header[0].startswith("#chrom\tstart\tend\tgene\tscore_DA\tstrand")
+        assert [row.split("\t")[3] for row in tabix.fetch("chr1")] == ["g1", "g2"]
+        assert list(tabix.fetch("chr1", 400, 600)) == ["chr1\t500\t550\tg2\t3\t-\t50\t"]
+
+    from ce_detector.scanner import children_output
+    from ce_detector.scanner import write_children
+
+    assert children_output("out/ce.tsv", "tsv") == "out/ce.children.tsv"
+    assert children_output("out/ce", "tsv") == "out/ce.children.tsv"
+    children = pd.DataFrame(
+        dict(
+            chrom=["chr1", "chr1"],
+            start=[100, 100],
+            end=[200, 200],
+            strand=["+", "+"],
+            gene=["g1", "g1"],
+            child_start=[150, 120],
+            child_end=[160, 130],
+        )
+    )
+    output = write_children(children, str(tmp_path / "ce.bed.gz"), "bed.gz")
+    assert output == str(tmp_path / "ce.children.bed.gz")
+    with pysam.TabixFile(output) as tabix:
+        assert [row.split("\t")[1] for row in tabix.fetch("chr1")] == ["120", "150"]
+
+    pytest.importorskip("pyarrow")
+    write_result(result, str(tmp_path / "ce.parquet"), "parquet")
+    assert pd.read_parquet(tmp_path / "ce.parquet").equals(result)
+
+
+def test_detect_missing_pyarrow(tmp_path, monkeypatch):
+    import sys
+
+    from click.testing import CliRunner
+
+    from ce_detector.cli import cli
+
+    # importing a module mapped to None raises ImportError
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    for name in ("reads.bam", "ref.fa", "ann.db"):
+        (tmp_path / name).write_text("")
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "detect",
+            "-b",
+            str(tmp_path / "reads.bam"),
+            "-r",
+            str(tmp_path / "ref.fa"),
+            "-db",
+            str(tmp_path / "ann.db"),
+            "--format",
+            "parquet",
+        ],
+    )
+    assert result.exit_code == 2
+    assert "ce_detector[arrow]" in result.output
+    assert not isinstance(result.exception, ImportError)
+
+
+def test_detect_cohort(tmp_path):
+    import pandas as pd
+    from click.testing import CliRunner
+
+    from benchmarks.synthetic import generate
+    from ce_detector.cli import cli
+
+    data = generate(str(tmp_path), chroms=2, genes=4, depth=8, background=200)
+    (tmp_path / "broken.bam").write_text("not a bam file")
+    bam_list = tmp_path / "bams.txt"
+    bam_list.write_text(f"s1\t{data['bam']}\ns2\tbroken.bam\n")
+
+    out = tmp_path / "cohort"
+    args = ["detect", "--bam-list", str(bam_list), "-r", data["reference"]]
+    args += ["-db", data["db"], "-o", str(out), "--no-cache"]
+
+    # finished samples are written even if another sample fails
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code != 0
+    assert len(pd.read_csv(out / "s1.tsv", sep="\t")) == data["cryptic_exons"]
+    assert not (out / "junctions.mtx").exists()
+
+    bam_list.write_text(f"s1\t{data['bam']}\ns2\t{data['bam']}\n")
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert (out / "s2.tsv").read_text() == (out / "s1.tsv").read_text()
+    samples = pd.read_csv(out / "cryptic_exons.samples.tsv", sep="\t")
+    assert samples["sample"].tolist() == ["s1", "s2"]
+    features = pd.read_csv(out / "cryptic_exons.features.tsv", sep="\t")
+    assert len(features) == data["cryptic_exons"]
+
+
+def test_junction_cache(tmp_path):
+    import numpy as np
+
+    from ce_detector.cache import JunctionCache
+    from ce_detector.detector import JunctionMap
+
+    bam, reference = tmp_path / "reads.bam", tmp_path / "ref.fa"
+    bam.write_bytes(b"bam")
+    reference.write_text(">chr1\nACGT\n")
+
+    jmap = JunctionMap("chr1")
+    jmap.append(
+        start=[10, 60],
+        end=[50, 90],
+        idn=[0, 1],
+        score=[3, 1],
+        strand=[0, 1],
+        anchor=[1, 2],
+        acceptor=[3, 4],
+        pvalue=[0.01, 0.5],
+    )
+
+    cache = JunctionCache(str(tmp_path / "cache"))
+    key = cache.key(str(bam), str(reference), "chr1", "NC_1", 30)
+    assert cache.get(key, "chr1") is None
+    assert key != cache.key(str(bam), str(reference), "chr1", "NC_1", 20)
+
+    cache.put(key, jmap)
+    cached = cache.get(key, "chr1")
+    assert cached.chrom == "chr1" and cached.size() == 2
+    for name, column in jmap.columns.items():
+        assert cached.columns[name].dtype == column.dtype
+        assert np.array_equal(cached.columns[name], column, equal_nan=True)
+
+    # rewriting bam file changes the key
+    bam.write_bytes(b"bam file")
+    assert key != cache.key(str(bam), str(reference), "chr1", "NC_1", 30)
+
+
+def test_cohort_matrix(tmp_path):
+    import pandas as pd
+    from scipy import io
+
+    from ce_detector.cohort import count_matrix
+    from ce_detector.cohort import read_bam_list
+    from ce_detector.cohort import write_matrix
+
+    bam_list = tmp_path / "samples.txt"
+    bam_list.write_text("# cohort\ns1\tbams/a.bam\n\n/data/b.bam\n")
+    assert read_bam_list(str(bam_list)) == {
+        "s1": str(tmp_path / "bams" / "a.bam"),
+        "b": "/data/b.bam",
+    }
+
+    tables = {
+        "s1": pd.DataFrame(
+            dict(chrom="chr1", start=[10, 30], end=[20, 40], strand="+", score=[3, 1])
+        ),
+        "s3": pd.DataFrame(
+            dict(chrom="chr1", start=[30, 5], end=[40, 8], strand="+", score=[7, 2])
+        ),
+    }
+    tables["s2"] = tables["s1"].iloc[:0]
+    tables = {sample: tables[sample] for sample in ("s1", "s2", "s3")}
+
+    features, matrix = count_matrix(
+        tables, ["chrom", "start", "end", "strand"], "score"
+    )
+    assert features["start"].tolist() == [5, 10, 30]
+    assert matrix.toarray().tolist() == [[0, 0, 2], [3, 0, 0], [1, 0, 7]]
+
+    write_matrix(str(tmp_path / "junctions"), features, tables, matrix)
+    assert (io.mmread(str(tmp_path / "junctions.mtx")) != matrix).nnz == 0
+    assert (tmp_path / "junctions.samples.tsv").read_text() == "sample\ns1\ns2\ns3\n"
+
+
+def test_detect_synthetic(tmp_path):
+    import json
+
+    import pandas as pd
+    from click.testing import CliRunner
+
+    from benchmarks.synthetic import generate
+    from ce_detector.cli import cli
+
+    data = generate(str(tmp_path), chroms=2, genes=4, depth=8, background=200)
+    again = generate(str(tmp_path / "again"), 2, 4, 8, 200, build_db=False)
+    # generator is deterministic
+    for name in ("reference", "gff"):
+        with open(data[name]) as handle, open(again[name]) as other:
+            assert handle.read() == other.read()
+
+    out = str(tmp_path / "cryptic_exons.tsv")
+    result = CliRunner().invoke(
+        cli,
+        [
+            "detect",
+            "--bam",
+            data["bam"],
+            "--reference",
+            data["reference"],
+            "--gffdb",
+            data["db"],
+            "--out",
+            out,
+            "--no-cache",
+            "--children",
+            "--trace",
+            str(tmp_path / "trace.json"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    with open(tmp_path / "trace.json") as handle:
+        events = json.load(handle)["traceEvents"]
+    stages = {}
+    for event in events:
+        if event["ph"] == "X":
+            stages.setdefault(event["name"], []).append(event["args"])
+    # stages of scanner are recorded per chromosome
+    for stage in ("find_ce", "split_ce"):
+        assert {args["chrom"] for args in stages[stage]} == {"chr1", "chr2"}
+    # counts of scanner stages are recorded inside their spans
+    assert (
+        sum(args["cryptic_exons"] for args in stages["find_ce"])
+        == data["cryptic_exons"]
+    )
+    assert all(args["annotations"] for args in stages["find_ce"])
+    assert (
+        sum(args["candidates"] for args in stages["split_ce"]) >= data["cryptic_exons"]
+    )
+
+    cryptic_exons = pd.read_csv(out, sep="\t")
+    assert len(cryptic_exons) == data["cryptic_exons"]
+    assert (cryptic_exons["length"] == 200).all()
+    assert (
+        cryptic_exons["children"]
+        == cryptic_exons["start"].map(lambda start: f"{start + 20}-{start + 120},")
+    ).all()
+
+    # long-format children are written next to cryptic exons
+    children = pd.read_csv(tmp_path / "cryptic_exons.children.tsv", sep="\t")
+    assert len(children) == len(cryptic_exons)
+    assert (children["child_start"] == children["start"] + 20).all()
+
+
+def test_detect_cached(tmp_path):
+    from click.testing import CliRunner
+
+    from benchmarks.synthetic import generate
+    from ce_detector.cli import cli
+
+    # default detection shares caches between threads of many chromosomes
+    data = generate(str(tmp_path), chroms=12, genes=10, depth=8, background=100)
+    args = ["detect", "-b", data["bam"], "-r", data["reference"], "-db", data["db"]]
+
+    outputs = {}
+    for run, options in (
+        ("plain", ["--no-cache"]),
+        ("cold", ["--cache-dir", str(tmp_path / "cache")]),
+        ("warm", ["--cache-dir", str(tmp_path / "cache")]),
+    ):
+        out = tmp_path / f"{run}.tsv"
+        result = CliRunner().invoke(cli, [*args, "--out", str(out), *options])
+        assert result.exit_code == 0, result.output
+        outputs[run] = out.read_text()
+
+    assert outputs["cold"] == outputs["plain"]
+    assert outputs["warm"] == outputs["plain"]
+
+
+def test_merge_detection(tmp_path):
+    import numpy as np
+
+    from benchmarks.synthetic import generate
+    from ce_detector.detector import open_alignment
+    from ce_detector.main import detection_window
+    from ce_detector.main import merge_detection
+
+    data = generate(str(tmp_path), chroms=1, genes=4, depth=8, background=100)
+    parts = [
+        detection_window("chr1", start, end, data["bam"], data["reference"], 0, False)
+        for start, end in ((0, 20000), (20000, None))
+    ]
+    # windows of a thread share one handle of bam file
+    assert open_alignment(data["bam"]) is open_alignment(data["bam"])
+
+    # merging only reads genome reference
+    missing = str(tmp_path / "missing.bam")
+    merged = merge_detection(
+        "chr1", "NC_000001.11", parts, missing, data["reference"], 0, False
+    )
+    whole = detection_window("chr1", 0, None, data["bam"], data["reference"], 0, False)
+    assert merged.size() == len(whole[0]) > 0
+    assert np.array_equal(
+        merged.columns["score"], [score for _, score in sorted(whole[0].items())]
+    )
+
+
+def test_detect_pipelined(tmp_path):
+    from concurrent import futures
+
+    from benchmarks.synthetic import generate
+    from ce_detector import metrics
+    from ce_detector.index import get_seqids
+    from ce_detector.main import get_contigs
+    from ce_detector.main import pipeline
+    from ce_detector.utils import get_alias
+
+    data = generate(str(tmp_path), chroms=3, genes=10, depth=8, background=200)
+    contigs = get_contigs(data["bam"], get_seqids(data["db"]), get_alias())
+
+    metrics.enable(str(tmp_path / "records"))
+    try:
+        # one worker runs tasks in order of submission
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            pipeline(
+                executor,
+                {chrom: seqid for chrom, (seqid, _) in contigs.items()},
+                data["bam"],
+                data["reference"],
+                0,
+                5000,
+                data["db"],
+                0,
+                False,
+            )
+        records = metrics.collect()
+    finally:
+        metrics.disable()
+
+    def spans(stage):
+        return [
+            (entry["chrom"], entry["start"], entry["start"] + entry["wall"])
+            for entry in records
+            if entry["stage"] == stage
+        ]
+
+    # annotation of a chromosome starts before detection of another one ends
+    chrom, start, _ = min(spans("Junction Annotator"), key=lambda span: span[1])
+    assert any(other != chrom and end > start for other, _, end in spans("BAM sweep"))
+
+
+def test_metrics(tmp_path):
+    import json
+    from concurrent import futures
+
+    from ce_detector import metrics
+    from ce_detector.utils import measure
+
+    def stage(chrom, reads):
+        with measure("stage", chrom=chrom):
+            metrics.add_counts(reads=reads)
+            metrics.add_counts(reads=reads, junctions=1)
+
+    # nothing is recorded while disabled
+    stage("chr1", 1)
+
+    metrics.enable(str(tmp_path / "records"))
+    try:
+        with futures.ThreadPoolExecutor(2) as executor, metrics.labelled(sample="s1"):
+            tasks = [
+                metrics.submit(executor, stage, chrom, reads)
+                for chrom, reads in (("chr1", 10), ("chr2", 5), ("chr1", 1))
+            ]
+            futures.wait(tasks)
+    finally:
+        metrics.finish(str(tmp_path / "metrics.json"), str(tmp_path / "records"))
+
+    assert metrics.get_directory() is None
+    assert not (tmp_path / "records").exists()
+
+    report = json.loads((tmp_path / "metrics.json").read_text())
+    assert len(report["records"]) == 3
+    assert {entry["sample"] for entry in report["records"]} == {"s1"}
+
+    (summary,) = report["stages"]
+    assert summary["tasks"] == 3
+    assert summary["counts"] == {"reads": 32, "junctions": 3}
+    assert {
+        entry["chrom"]: entry["counts"]["reads"] for entry in report["chromosomes"]
+    } == {"chr1": 22, "chr2": 10}
+
+    # memory of a stage is its own RSS change, not the process-wide peak
+    metrics.enable(str(tmp_path / "records"))
+    try:
+        with measure("allocate"):
+            block = b"x" * (64 << 20)
+        del block
+        (entry,) = metrics.collect()
+    finally:
+        metrics.finish(None, str(tmp_path / "records"))
+
+    assert 60 < entry["rss_delta_mb"] <= entry["peak_rss_mb"]
+
+
+def test_trace_events():
+    from ce_detector.metrics import trace_events
+
+    record = dict(
+        chrom="chr1",
+        sample="s1",
+        wall=0.5,
+        cpu=0.25,
+        rss_delta_mb=0.5,
+        peak_rss_mb=1.0,
+        counts={"reads": 10},
+    )
+    records = [
+        dict(record, stage="Pipeline", pid=1, thread=11, start=100.0, wall=2.0),
+        dict(record, stage="BAM sweep", pid=2, thread=22, start=100.5),
+        dict(record, stage="P-value", pid=1, thread=12, start=101.0),
+    ]
+
+    events = trace_events(records, main_pid=1)
+    names = {
+        (event["pid"], event["tid"]): event["args"]["name"]
+        for event in events
+        if event["ph"] == "M"
+    }
+    assert names == {
+        (1, 0): "ce_detector",
+        (2, 0): "worker 2",
+        (1, 1): "thread 1",
+        (1, 2): "thread 2",
+        (2, 1): "thread 1",
+    }
+
+    stages = [event for event in events if event["ph"] == "X"]
+    assert [(event["name"], event["ts"], event["dur"]) for event in stages] == [
+        ("Pipeline", 0.0, 2e6),
+        ("BAM sweep", 5e5, 5e5),
+        ("P-value", 1e6, 5e5),
+    ]
+    assert [(event["pid"], event["tid"]) for event in stages] == [
+        (1, 1),
+        (2, 1),
+        (1, 2),
+    ]
+    assert stages[1]["args"] == dict(
+        chrom="chr1",
+        sample="s1",
+        cpu=0.25,
+        rss_delta_mb=0.5,
+        peak_rss_mb=1.0,
+        reads=10,
+    )
+
+
+def test_profiler(tmp_path):
+    import pstats
+    from concurrent import futures
+
+    from ce_detector import metrics
+    from ce_detector import profiler
+
+    def hot_function(n):
+        return sum(range(n))
+
+    directory = str(tmp_path / "tasks")
+    profiler.enable(directory)
+    try:
+        with futures.ThreadPoolExecutor(2) as executor:
+            tasks = [metrics.submit(executor, hot_function, n) for n in (10, 100, 1000)]
+            assert [task.result() for task in tasks] == [45, 4950, 499500]
+    finally:
+        summary = profiler.finish(str(tmp_path), directory)
+
+    assert profiler.get_directory() is None
+    assert not (tmp_path / "tasks").exists()
+    assert "hot_function" in summary
+    assert (tmp_path / "summary.txt").read_text() == summary
+
+    stats = pstats.Stats(str(tmp_path / "ce_detector.prof"))
+    (calls,) = [
+        value[1] for key, value in stats.stats.items() if key[2] == "hot_function"
+    ]
+    assert calls == 3
+
+
+def test_import_budget():
+    import subprocess
+    import sys
+
+    # heavy dependencies are only imported by commands using them
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import ce_detector.cli\n"
+        "elapsed = time.perf_counter() - start\n"
+        "heavy = ('pandas', 'pysam', 'gffutils', 'statsmodels', 'scipy', 'rich', 'yaml', 'numpy')\n"
+        "print(elapsed, *sorted(set(heavy) & set(sys.modules)))\n"
+    )
+    elapsed, *heavy = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout.split()
+
+    assert heavy == []
+    assert float(elapsed) < 1.0
+
+    from ce_detector import annotator
+    from ce_detector.utils import get_alias
+
+    assert annotator.CHROMS == get_alias()